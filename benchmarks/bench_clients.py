@@ -0,0 +1,168 @@
+"""
+Throughput and latency benchmarks for the VirtualCrypto clients.
+
+Runs against a local mock API server, so no credentials or network are needed::
+
+    python -m benchmarks.bench_clients --requests 500 --latency 0.005 --error-rate 0.01
+"""
+import argparse
+import asyncio
+import json
+import time
+from dataclasses import dataclass, field
+from typing import Callable
+
+from virtualcrypto import AsyncVirtualCryptoClient, VirtualCryptoClient, Scope, Claim, Balance
+from payout import pay_all
+from benchmarks.mock_server import MockVirtualCrypto
+
+SCOPES = [Scope.Pay, Scope.Claim]
+
+
+@dataclass
+class Result:
+    name: str
+    latencies: list[float] = field(default_factory=list)
+    errors: int = 0
+    elapsed: float = 0.0
+
+    def percentile(self, p: float) -> float:
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+    def row(self) -> str:
+        ops = len(self.latencies) + self.errors
+        throughput = ops / self.elapsed if self.elapsed else 0.0
+        return (f"{self.name:<28}{ops:>8}{throughput:>12.1f}"
+                f"{self.percentile(0.50) * 1000:>10.2f}{self.percentile(0.99) * 1000:>10.2f}{self.errors:>8}")
+
+
+def header() -> str:
+    return f"{'benchmark':<28}{'ops':>8}{'ops/s':>12}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}"
+
+
+def run_sync(name: str, n: int, fn: Callable[[], object]) -> Result:
+    result = Result(name)
+    start = time.perf_counter()
+    for _ in range(n):
+        t = time.perf_counter()
+        try:
+            fn()
+        except Exception:
+            result.errors += 1
+        else:
+            result.latencies.append(time.perf_counter() - t)
+    result.elapsed = time.perf_counter() - start
+    return result
+
+
+async def run_async(name: str, n: int, fn) -> Result:
+    result = Result(name)
+    start = time.perf_counter()
+    for _ in range(n):
+        t = time.perf_counter()
+        try:
+            await fn()
+        except Exception:
+            result.errors += 1
+        else:
+            result.latencies.append(time.perf_counter() - t)
+    result.elapsed = time.perf_counter() - start
+    return result
+
+
+def bench_parse(server: MockVirtualCrypto, n: int) -> list[Result]:
+    claims = json.loads(server.claims_body)
+    balances = json.loads(server.balances_body)
+    return [
+        run_sync(f"parse claims x{len(claims)}", n, lambda: Claim.by_json_list(claims)),
+        run_sync(f"parse balances x{len(balances)}", n, lambda: Balance.by_json_list(balances)),
+    ]
+
+
+def bench_sync_client(server: MockVirtualCrypto, n: int, concurrency: int) -> list[Result]:
+    with VirtualCryptoClient("id", "secret", SCOPES, max_workers=concurrency, endpoint=server.endpoint) as client:
+        results = [
+            run_sync("sync token", n, client.set_token),
+            run_sync("sync pay", n, lambda: client.pay("vc", 1, 1)),
+            run_sync("sync get_claims", n, client.get_claims),
+            run_sync("sync get_balances", n, client.get_balances),
+        ]
+
+        bulk = Result(f"sync pay_many c={concurrency}")
+        start = time.perf_counter()
+        items = client.pay_many("vc", [(i, 1) for i in range(n)])
+        bulk.elapsed = time.perf_counter() - start
+        # pay_many does not time single transfers, so report the mean per transfer
+        bulk.latencies = [bulk.elapsed / n for item in items if item.ok]
+        bulk.errors = sum(1 for item in items if not item.ok)
+        results.append(bulk)
+    return results
+
+
+async def bench_async_client(server: MockVirtualCrypto, n: int, concurrency: int) -> list[Result]:
+    client = AsyncVirtualCryptoClient("id", "secret", SCOPES, endpoint=server.endpoint)
+    try:
+        await client.start()
+        results = [
+            await run_async("async token", n, client.set_token),
+            await run_async("async pay", n, lambda: client.pay("vc", 1, 1)),
+            await run_async("async get_claims", n, client.get_claims),
+            await run_async("async get_balances", n, client.get_balances),
+        ]
+
+        bulk = Result(f"async pay_all c={concurrency}")
+        started: dict[int, float] = {}
+
+        async def on_result(item):
+            if item.ok:
+                bulk.latencies.append(time.perf_counter() - started[item.receiver_id])
+            else:
+                bulk.errors += 1
+
+        def payouts():
+            for i in range(n):
+                started[i] = time.perf_counter()
+                yield i, 1
+
+        start = time.perf_counter()
+        await pay_all(client, "vc", payouts(), concurrency=concurrency, on_result=on_result)
+        bulk.elapsed = time.perf_counter() - start
+        results.append(bulk)
+        return results
+    finally:
+        await client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200, help="operations per benchmark")
+    parser.add_argument("--concurrency", type=int, default=8, help="parallel transfers for bulk benchmarks")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds the mock server waits before answering")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of transfers answered with 400")
+    parser.add_argument("--claims", type=int, default=50, help="claims returned by GET /users/@me/claims")
+    parser.add_argument("--balances", type=int, default=20, help="balances returned by GET /users/@me/balances")
+    parser.add_argument("--output", help="also write the report to this file")
+    args = parser.parse_args()
+
+    server = MockVirtualCrypto(latency=args.latency, error_rate=args.error_rate,
+                               claims=args.claims, balances=args.balances).start()
+    try:
+        results = bench_parse(server, args.requests)
+        results += bench_sync_client(server, args.requests, args.concurrency)
+        results += asyncio.run(bench_async_client(server, args.requests, args.concurrency))
+    finally:
+        server.stop()
+
+    lines = [header()] + [r.row() for r in results]
+    report = "\n".join(lines)
+    print(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+
+
+if __name__ == "__main__":
+    main()
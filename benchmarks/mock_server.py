@@ -0,0 +1,142 @@
+"""Local stand-in for the VirtualCrypto API used by the client benchmarks."""
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import urlparse
+
+
+def discord_user_json(user_id: int) -> dict:
+    return {
+        "id": str(user_id),
+        "username": f"user{user_id}",
+        "discriminator": "0001",
+        "avatar": "0" * 32,
+        "public_flags": 0,
+        "bot": False
+    }
+
+
+def currency_json(unit: str = "vc") -> dict:
+    return {
+        "unit": unit,
+        "guild": "100000000000000000",
+        "name": f"{unit} coin",
+        "pool_amount": "1000000",
+        "total_amount": "10000000"
+    }
+
+
+def claim_json(claim_id: int, status: str = "pending") -> dict:
+    return {
+        "id": str(claim_id),
+        "amount": "100",
+        "claimant": {"id": "1", "discord": discord_user_json(1)},
+        "payer": {"id": str(claim_id + 1), "discord": discord_user_json(claim_id + 1)},
+        "currency": currency_json(),
+        "status": status,
+        "created_at": "2024-01-01T00:00:00Z",
+        "updated_at": "2024-01-01T00:00:00Z"
+    }
+
+
+def balance_json(index: int) -> dict:
+    return {"amount": str(1000 + index), "currency": currency_json(f"c{index}")}
+
+
+class MockVirtualCrypto(ThreadingHTTPServer):
+    """
+    Serves the token, currency, transaction, claim and balance endpoints.
+
+    Parameters
+    ----------
+    latency: :class:`float`
+        Seconds to sleep before answering each request.
+    error_rate: :class:`float`
+        Probability that a transfer is answered with 400.
+    claims: :class:`int`
+        How many claims ``GET /users/@me/claims`` returns.
+    balances: :class:`int`
+        How many balances ``GET /users/@me/balances`` returns.
+    """
+    daemon_threads = True
+
+    def __init__(self, port: int = 0, latency: float = 0.0, error_rate: float = 0.0, claims: int = 50, balances: int = 20):
+        super().__init__(("127.0.0.1", port), MockHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.claims_body = json.dumps([claim_json(i) for i in range(1, claims + 1)]).encode()
+        self.balances_body = json.dumps([balance_json(i) for i in range(balances)]).encode()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def endpoint(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self) -> "MockVirtualCrypto":
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    server: MockVirtualCrypto
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _route(self, method: str):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        path = re.sub(r"^/api/v\d", "", urlparse(self.path).path)
+        if method == "POST" and path == "/oauth2/token":
+            return self._send(200, {"access_token": "token", "expires_in": 86400, "token_type": "Bearer"})
+        if method == "GET" and path.startswith("/currencies"):
+            return self._send(200, currency_json())
+        if method == "POST" and path == "/users/@me/transactions":
+            if self.server.error_rate and random.random() < self.server.error_rate:
+                return self._send(400, {"error": "invalid_request", "error_info": "injected error"})
+            return self._send(200, {})
+        if path == "/users/@me/claims":
+            if method == "GET":
+                return self._send(200, self.server.claims_body)
+            if method == "POST":
+                return self._send(200, claim_json(1))
+        match = re.fullmatch(r"/users/@me/claims/(\d+)", path)
+        if match:
+            status = "approved" if method == "PATCH" else "pending"
+            return self._send(200, claim_json(int(match.group(1)), status))
+        if method == "GET" and path == "/users/@me/balances":
+            return self._send(200, self.server.balances_body)
+        return self._send(404, {"error": "not_found", "error_description": path})
+
+    def do_GET(self):
+        self._route("GET")
+
+    def do_POST(self):
+        self._route("POST")
+
+    def do_PATCH(self):
+        self._route("PATCH")
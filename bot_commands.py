@@ -4,69 +4,338 @@ from discord import app_commands, Embed, User, Role, Member, Interaction
 from virtualcrypto import AsyncVirtualCryptoClient, Scope, ClaimStatus, Claim
 import sqlite3
 import embedColour
+import metrics
 import asyncio
+import hashlib
+import json
 from time import time
-from typing import Optional
+from typing import AsyncIterator, Optional
 
-from db_structs import RewardPool, RewardConfig, UserRewardCooldown
+from db_structs import RewardPool, RewardConfig
+from database import Database
+from payout import PayoutSummary, transfer_not_sent
+from reward_cache import RewardCache, CooldownIndex
+from settlement import RewardSettler
+from payout_jobs import PayoutJobs
+from compaction import CooldownCompactor
+import ledger
+from voice_rewards import VoiceSessions
+from idempotency import SQLiteIdempotencyStore
+from claim_watcher import ClaimWatcher
+from currency_cache import CurrencyCache
+from sharding import ShardLayout
 
 
-async def VCClient() -> AsyncVirtualCryptoClient:
+shard_layout = ShardLayout.from_config(0, config.Sharding.shard_count, config.Sharding.processes)
+
+def use_shard_layout(layout: ShardLayout):
     """
-    非同期のVirtualCryptoクライアントを初期化して返します。
+    このプロセスが担当するシャードを設定します。各種タスクを開始する前に呼び出してください。
     """
-    cli = AsyncVirtualCryptoClient(
-        client_id=config.VirtualCrypto.client_id,
-        client_secret=config.VirtualCrypto.client_secret,
-        scopes=[Scope.Pay, Scope.Claim]
-    )
-    await cli.start()
-    return cli
-
-DBConnection = sqlite3.connect("database.db")
-def dict_factory(cursor, row):
-    d = {}
-    for idx, col in enumerate(cursor.description):
-        d[col[0]] = row[idx]
-    return d
-
-DBConnection.row_factory = dict_factory
-cursor = DBConnection.cursor()
-
-cursor.execute("""
-    CREATE TABLE IF NOT EXISTS reward_pools (
-        guild_id INTEGER PRIMARY KEY,
-        unit TEXT NOT NULL,
-        pool_balance INTEGER NOT NULL DEFAULT 0
-    )
-""")
-cursor.execute("""
-    CREATE TABLE IF NOT EXISTS reward_configs (
-        config_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        guild_id INTEGER NOT NULL,
-        reward_type TEXT NOT NULL,
-        amount INTEGER NOT NULL,
-        cooldown_seconds INTEGER DEFAULT 0,
-        FOREIGN KEY (guild_id) REFERENCES reward_pools(guild_id) ON DELETE CASCADE,
-        UNIQUE (guild_id, reward_type)
-    )
-""")
-cursor.execute("""
-    CREATE TABLE IF NOT EXISTS user_reward_cooldowns (
-        user_id INTEGER NOT NULL,
-        guild_id INTEGER NOT NULL,
-        reward_type TEXT NOT NULL,
-        last_triggered_timestamp INTEGER NOT NULL,
-        PRIMARY KEY (user_id, guild_id, reward_type)
-    )
-""")
-cursor.execute("""
-    CREATE TABLE IF NOT EXISTS receive_msg (
-        user_id INTEGER PRIMARY KEY
+    global shard_layout
+    shard_layout = layout
+
+_vc_client: Optional[AsyncVirtualCryptoClient] = None
+claim_watcher: Optional[ClaimWatcher] = None
+currency_cache: Optional[CurrencyCache] = None
+
+async def start_vc_client() -> AsyncVirtualCryptoClient:
+    """
+    プロセス全体で共有する非同期VirtualCryptoクライアントを初期化します。
+    起動時に一度だけ呼び出してください。
+    """
+    global _vc_client, claim_watcher, currency_cache
+    if _vc_client is None:
+        cli = AsyncVirtualCryptoClient(
+            client_id=config.VirtualCrypto.client_id,
+            client_secret=config.VirtualCrypto.client_secret,
+            scopes=[Scope.Pay, Scope.Claim],
+            connection_limit=config.VirtualCrypto.connection_limit,
+            dns_cache_ttl=config.VirtualCrypto.dns_cache_ttl,
+            keepalive_timeout=config.VirtualCrypto.keepalive_timeout,
+            # レート制限はクライアントごとなので、プロセス間で均等に分ける
+            rate_limit=config.VirtualCrypto.rate_limit / shard_layout.process_count if config.VirtualCrypto.rate_limit else None,
+            rate_burst=max(1, config.VirtualCrypto.rate_burst // shard_layout.process_count),
+            request_timeout=config.VirtualCrypto.request_timeout,
+            max_retries=config.VirtualCrypto.max_retries,
+            retry_backoff=config.VirtualCrypto.retry_backoff,
+            hedge_delay=config.VirtualCrypto.hedge_delay,
+            idempotency_store=idempotency_store,
+            token_refresh_margin=config.VirtualCrypto.token_refresh_margin,
+            token_cache_path=config.VirtualCrypto.token_cache_path
+        )
+        cli.on_request = metrics.observe_api
+        await cli.start()
+        _vc_client = cli
+        claim_watcher = ClaimWatcher(
+            cli,
+            timeout=config.ClaimWatch.timeout,
+            fast_interval=config.ClaimWatch.fast_interval,
+            slow_interval=config.ClaimWatch.slow_interval,
+            fast_period=config.ClaimWatch.fast_period
+        )
+        currency_cache = CurrencyCache(
+            cli,
+            ttl=config.VirtualCrypto.currency_cache_ttl,
+            max_size=config.VirtualCrypto.currency_cache_size
+        )
+    return _vc_client
+
+async def close_vc_client():
+    """
+    共有クライアントのセッションを閉じます。終了時に呼び出してください。
+    """
+    global _vc_client, claim_watcher
+    if claim_watcher is not None:
+        watcher, claim_watcher = claim_watcher, None
+        await watcher.close()
+    if _vc_client is not None:
+        cli, _vc_client = _vc_client, None
+        await cli.close()
+
+reward_settler: Optional[RewardSettler] = None
+
+async def start_reward_settler():
+    """
+    積み立てモードが有効な場合、中断された精算を照合してから報酬の精算タスクを開始します。
+    """
+    global reward_settler
+    if config.Reward.settle_mode and reward_settler is None:
+        settler = RewardSettler(
+            db,
+            interval=config.Reward.settle_interval,
+            threshold=config.Reward.settle_threshold,
+            concurrency=config.Payout.concurrency,
+            owns=shard_layout.owns
+        )
+        await settler.resume()
+        settler.start(VCClient())
+        reward_settler = settler
+
+payout_jobs: Optional[PayoutJobs] = None
+
+async def start_payout_jobs():
+    """
+    前回の起動で終わらなかった一括送金ジョブを再開します。
+    """
+    global payout_jobs
+    if payout_jobs is None:
+        payout_jobs = PayoutJobs(
+            db,
+            concurrency=config.Payout.concurrency,
+            owner=shard_layout.process_index,
+            batch_size=config.Payout.batch_size
+        )
+        resumed = await payout_jobs.resume(VCClient())
+        if resumed:
+            print(f"{len(resumed)}件の送金ジョブを再開しました。")
+
+async def stop_payout_jobs():
+    """
+    送金中のバッチが終わるまで待ってから送金ジョブを止めます。
+    """
+    global payout_jobs
+    if payout_jobs is not None:
+        jobs, payout_jobs = payout_jobs, None
+        await jobs.stop()
+
+cooldown_compactor: Optional[CooldownCompactor] = None
+
+def _report_compaction(removed: int, pruned: int):
+    metrics.cooldown_rows_compacted.inc(amount=removed)
+    metrics.transfer_keys_pruned.inc(amount=pruned)
+    if removed:
+        print(f"期限切れのクールダウンを{removed}件削除しました。")
+    if pruned:
+        print(f"古い送金の冪等キーを{pruned}件削除しました。")
+
+async def start_cooldown_compactor():
+    """
+    期限切れのクールダウンと古い送金の冪等キーを定期的に削除するタスクを開始します。
+    テーブルは全プロセスで共有しているため、最初のプロセスだけで実行します。
+    """
+    global cooldown_compactor
+    if shard_layout.is_primary and cooldown_compactor is None:
+        cooldown_compactor = CooldownCompactor(
+            db,
+            interval=config.CooldownCompaction.interval,
+            batch_size=config.CooldownCompaction.batch_size,
+            pause=config.CooldownCompaction.pause,
+            idempotency_store=idempotency_store,
+            idempotency_ttl=config.VirtualCrypto.idempotency_ttl
+        )
+        cooldown_compactor.start(_report_compaction)
+
+async def stop_cooldown_compactor():
+    global cooldown_compactor
+    if cooldown_compactor is not None:
+        compactor, cooldown_compactor = cooldown_compactor, None
+        await compactor.stop()
+
+voice_sessions: Optional[VoiceSessions] = None
+
+async def _settle_voice(member: discord.Member, minutes: int) -> bool:
+    # 終了時の精算でも呼ばれるため、イベント用の`handle_reward`を通さない
+    return await _give_reward(config.Voice.reward_type, member, member.guild, quantity=minutes) != "cooldown"
+
+def _rewarded_voice_members(guilds: list[discord.Guild]) -> list[discord.Member]:
+    members = []
+    for guild in guilds:
+        if not reward_cache.get_config(guild.id, config.Voice.reward_type):
+            continue
+        for channel in guild.voice_channels + guild.stage_channels:
+            if channel == guild.afk_channel:
+                continue
+            members.extend(member for member in channel.members if not member.bot)
+    return members
+
+async def start_voice_sessions(guilds: list[discord.Guild]):
+    """
+    ボイス報酬のチェックポイントを開始し、既にボイスチャンネルにいるメンバーのセッションを開始します。
+    """
+    global voice_sessions
+    if voice_sessions is None:
+        voice_sessions = VoiceSessions(_settle_voice, interval=config.Voice.checkpoint_interval)
+        voice_sessions.start()
+    await sync_voice_sessions(guilds)
+
+async def sync_voice_sessions(guilds: list[discord.Guild], shard_id: Optional[int] = None):
+    """
+    シャードの再接続後に、切断中に退出したメンバーのセッションを精算して終了し、参加したメンバーのセッションを開始します。
+    `shard_id`を指定した場合はそのシャードのサーバーだけを突き合わせます。
+    """
+    if voice_sessions is None:
+        return
+    if shard_id is None:
+        in_scope = shard_layout.owns
+    else:
+        guilds = [guild for guild in guilds if guild.shard_id == shard_id]
+        in_scope = lambda guild_id: shard_layout.shard_for(guild_id) == shard_id
+    joined, left = await voice_sessions.reconcile(_rewarded_voice_members(guilds), in_scope)
+    if joined or left:
+        print(f"ボイスセッションを突き合わせました (開始: {joined}件, 終了: {left}件)")
+
+async def stop_voice_sessions():
+    """
+    チェックポイントを止め、参加中のメンバーの経過分を精算します。
+    """
+    global voice_sessions
+    if voice_sessions is not None:
+        sessions, voice_sessions = voice_sessions, None
+        await sessions.stop()
+
+async def close_database():
+    """
+    データベースの書き込みスレッドと読み込み用スレッドを停止します。
+    """
+    await db.close()
+
+async def stop_reward_settler():
+    """
+    精算タスクを止め、残っている積み立て分を精算します。
+    """
+    global reward_settler
+    if reward_settler is not None:
+        settler, reward_settler = reward_settler, None
+        await settler.stop(VCClient())
+
+def VCClient() -> AsyncVirtualCryptoClient:
+    """
+    共有の非同期VirtualCryptoクライアントを返します。
+    """
+    if _vc_client is None:
+        raise RuntimeError("VirtualCrypto client is not started")
+    return _vc_client
+
+db = Database(
+    config.Database.path,
+    read_threads=config.Database.read_threads,
+    commit_window=config.Database.commit_window,
+    observer=metrics.observe_db
+)
+
+idempotency_store = SQLiteIdempotencyStore(db)
+reward_cache = RewardCache()
+cooldown_index = CooldownIndex()
+
+def _create_schema(cursor: sqlite3.Cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS reward_pools (
+            guild_id INTEGER PRIMARY KEY,
+            unit TEXT NOT NULL,
+            pool_balance INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS reward_configs (
+            config_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            guild_id INTEGER NOT NULL,
+            reward_type TEXT NOT NULL,
+            amount INTEGER NOT NULL,
+            cooldown_seconds INTEGER DEFAULT 0,
+            FOREIGN KEY (guild_id) REFERENCES reward_pools(guild_id) ON DELETE CASCADE,
+            UNIQUE (guild_id, reward_type)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_reward_cooldowns (
+            user_id INTEGER NOT NULL,
+            guild_id INTEGER NOT NULL,
+            reward_type TEXT NOT NULL,
+            last_triggered_timestamp INTEGER NOT NULL,
+            PRIMARY KEY (user_id, guild_id, reward_type)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS receive_msg (
+            user_id INTEGER PRIMARY KEY
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS bot_state (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+    """)
+    RewardSettler.create_table(cursor)
+    PayoutJobs.create_table(cursor)
+    ledger.create_table(cursor)
+    SQLiteIdempotencyStore.create_table(cursor)
+
+async def init_database():
+    """
+    テーブルを作成し、報酬設定とクールダウンをメモリに読み込みます。
+    起動時、最初のイベントを処理する前に一度だけ呼び出してください。
+    """
+    await db.write(_create_schema)
+    await reward_cache.load(db)
+    await cooldown_index.load(db, int(time()))
+
+# --- Command Sync ---
+
+def command_tree_fingerprint(tree: app_commands.CommandTree) -> str:
+    """
+    登録されているグローバルコマンドの定義からハッシュを計算します。
+    """
+    payload = sorted((cmd.to_dict(tree) for cmd in tree.get_commands()), key=lambda c: (c.get("type", 1), c["name"]))
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+async def sync_command_tree(tree: app_commands.CommandTree) -> bool:
+    """
+    前回同期したときからコマンドの定義が変わっている場合だけ`tree.sync()`を実行します。
+    同期した場合はTrueを返します。
+    """
+    key = f"command_tree:{tree.client.application_id}"
+    fingerprint = command_tree_fingerprint(tree)
+    row = await db.fetchone("SELECT value FROM bot_state WHERE key = ?", (key,))
+    if row and row['value'] == fingerprint:
+        return False
+    await tree.sync()
+    await db.execute(
+        "INSERT INTO bot_state (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+        (key, fingerprint)
     )
-""")
-DBConnection.commit()
-cursor.close()
+    return True
 
 # --- Bot Information ---
 
@@ -94,37 +363,97 @@ async def create_claim_embed(vc_client:AsyncVirtualCryptoClient, payer_id:int, u
     return claim_embed, new_claim
 
 async def wait_for_claim_approval(interaction: Interaction, vc_client: AsyncVirtualCryptoClient, claim: Claim, original_embed: Embed) -> bool:
-    for i in range(12): # 10sec * 12 = 2min
-        await asyncio.sleep(10)
-        updated_claim = await vc_client.get_claim(claim.id)
+    updated_claim = await claim_watcher.wait(claim.id)
+    if updated_claim is not None:
         if updated_claim.status == ClaimStatus.Approved:
             return True
         if updated_claim.status in [ClaimStatus.Denied, ClaimStatus.Canceled]:
             cancel_embed = Embed(description="請求はキャンセルまたは拒否されました", colour=embedColour.Error)
             await interaction.edit_original_response(embeds=[original_embed, cancel_embed])
             return False
-    
+
     # Timeout
     await vc_client.update_claim(claim.id, ClaimStatus.Canceled)
     timeout_embed = Embed(description="操作はタイムアウトしました", colour=embedColour.Error)
     await interaction.edit_original_response(embeds=[original_embed, timeout_embed])
     return False
 
+def payout_summary_embed(claim: Claim, unit: str, amount_per_user: int, summary: PayoutSummary) -> Embed:
+    """
+    一括送金の結果をまとめたEmbedを作成します。
+    """
+    paid = summary.paid
+    failed = summary.failed
+    if not failed:
+        embed = Embed(title="処理が完了しました", colour=embedColour.Success)
+        embed.description = f"請求`{claim.id}`は承認され、{len(paid)}人のメンバーに **{amount_per_user} {unit}** を配布しました。"
+        return embed
+
+    embed = Embed(title="一部の送金に失敗しました", colour=embedColour.Orange)
+    embed.description = f"請求`{claim.id}`は承認され、{len(paid)}人のメンバーに **{amount_per_user} {unit}** を配布しました。"
+    embed.add_field(name="成功", value=f"{len(paid)}人")
+    embed.add_field(name="失敗", value=f"{len(failed)}人")
+    failed_text = ""
+    for result in failed:
+        line = f"<@{result.receiver_id}>: {type(result.error).__name__}\n"
+        if len(failed_text) + len(line) > 1000:
+            failed_text += "..."
+            break
+        failed_text += line
+    embed.add_field(name="送金できなかったメンバー", value=failed_text, inline=False)
+    return embed
+
+async def unit_exists(unit: str) -> bool:
+    """
+    通貨単位が存在するかをキャッシュ経由で確認します。
+    """
+    return await currency_cache.get_by_unit(unit) is not None
+
+async def iter_role_member_ids(role: Role) -> AsyncIterator[int]:
+    """
+    ロールを持つメンバーのidを順に返します。
+    サーバーのメンバーがすべてキャッシュされていない場合はAPIから1000人ずつ取得します。
+    """
+    guild = role.guild
+    if guild.chunked:
+        members = guild.members
+        for member in members:
+            if role.is_default() or member.get_role(role.id):
+                yield member.id
+        return
+    async for member in guild.fetch_members(limit=None):
+        if role.is_default() or member.get_role(role.id):
+            yield member.id
+
+# インタラクションのトークンは15分で失効し、それ以降は応答を編集できない
+INTERACTION_TOKEN_SECONDS = 15 * 60
+
+def interaction_time_left(interaction: Interaction, margin: float = 30) -> float:
+    elapsed = (discord.utils.utcnow() - interaction.created_at).total_seconds()
+    return max(0.0, INTERACTION_TOKEN_SECONDS - margin - elapsed)
+
+def unknown_unit_embed(unit: str) -> Embed:
+    return Embed(title="エラー", description=f"通貨単位 **{unit}** は存在しません。", colour=embedColour.Error)
+
 # --- Core Commands ---
 
 @app_commands.command(name="rain",description="通貨を特定のロールのメンバーに配ります")
 @app_commands.describe(unit="通貨の単位", amount_per_user="1ユーザーあたりの数量", role="ロール")
 async def rain(interaction:Interaction, unit:str, amount_per_user:int, role:Role):
     await interaction.response.defer(thinking=True)
-    vc_client = None
+    staged_job = None
     try:
-        role_mems = role.members
-        member_count = len(role_mems)
+        if not await unit_exists(unit):
+            await interaction.edit_original_response(embed=unknown_unit_embed(unit))
+            return
+        staged_job, member_count = await payout_jobs.stage(
+            interaction.guild_id, unit, ((member_id, amount_per_user) async for member_id in iter_role_member_ids(role))
+        )
         if member_count == 0:
             await interaction.edit_original_response(embed=Embed(title="エラー", description="対象ロールにメンバーがいません。", colour=embedColour.Error))
             return
         
-        vc_client = await VCClient()
+        vc_client = VCClient()
         total_amount = amount_per_user * member_count
         claim_embed, new_claim = await create_claim_embed(vc_client, interaction.user.id, unit, total_amount, f"通貨のエアドロップ({amount_per_user} * {member_count})")
         await interaction.followup.send(embeds=[claim_embed])
@@ -132,31 +461,55 @@ async def rain(interaction:Interaction, unit:str, amount_per_user:int, role:Role
         if not await wait_for_claim_approval(interaction, vc_client, new_claim, claim_embed):
             return
 
-        for mem in role_mems:
-            await vc_client.pay(unit, mem.id, amount_per_user)
+        job_id = staged_job
+        try:
+            await payout_jobs.activate(vc_client, job_id, new_claim.id)
+        except Exception:
+            # 請求は支払われているので、ジョブは削除せずに照合用に残す
+            staged_job = None
+            print(f"Failed to start payout job {job_id} for approved claim {new_claim.id}; keeping it for reconciliation")
+            try:
+                await payout_jobs.hold(job_id, new_claim.id)
+            except Exception as e:
+                print(f"Failed to hold payout job {job_id} for claim {new_claim.id}: {e}")
+            raise
+        staged_job = None
+        progress_embed = Embed(title="配布中", colour=embedColour.LightBlue)
+        progress_embed.description = f"請求`{new_claim.id}`は承認されました。{member_count}人への配布をバックグラウンドで実行しています。"
+        progress_embed.set_footer(text=f"ジョブid: {job_id}")
+        await interaction.edit_original_response(embeds=[claim_embed, progress_embed])
 
-        confirm_embed = Embed(title="処理が完了しました", colour=embedColour.Success)
-        confirm_embed.description = f"請求`{new_claim.id}`は承認され、{member_count}人のメンバーに **{amount_per_user} {unit}** を配布しました。"
-        await interaction.edit_original_response(embeds=[claim_embed, confirm_embed])
+        try:
+            summary = await asyncio.wait_for(payout_jobs.wait(job_id), timeout=interaction_time_left(interaction))
+        except asyncio.TimeoutError:
+            # ジョブは止めずに、応答を編集できるうちに結果を待つのをやめる
+            progress_embed.description += "\n時間がかかっているため結果はここに表示されませんが、配布はこのまま続きます。"
+            await interaction.edit_original_response(embeds=[claim_embed, progress_embed])
+            return
+        await interaction.edit_original_response(embeds=[claim_embed, payout_summary_embed(new_claim, unit, amount_per_user, summary)])
 
     except Exception as e:
-        await interaction.edit_original_response(embed=Embed(title="内部エラー", description=f"{e.__class__.__name__}:\n{e}", colour=embedColour.Error))
+        try:
+            await interaction.edit_original_response(embed=Embed(title="内部エラー", description=f"{e.__class__.__name__}:\n{e}", colour=embedColour.Error))
+        except discord.HTTPException:
+            print(f"Error in rain: {type(e).__name__}: {e}")
     finally:
-        if vc_client: await vc_client.close()
+        if staged_job is not None:
+            await payout_jobs.discard(staged_job)
 
 @app_commands.command(name="send_with_msg",description="DMでのメッセージと一緒に通貨を送信します")
 @app_commands.describe(unit="通貨単位", user="対象ユーザー", amount="数量", message="メッセージ")
 async def send_with_msg(interaction:Interaction, unit:str, user:Member, amount:int, message:str):
     await interaction.response.defer(thinking=True)
-    vc_client = None
-    cursor = DBConnection.cursor()
     try:
-        cursor.execute("SELECT * FROM receive_msg WHERE user_id = ?", (user.id,))
-        if not cursor.fetchone():
+        if not await db.fetchone("SELECT * FROM receive_msg WHERE user_id = ?", (user.id,)):
             await interaction.edit_original_response(embed=Embed(title="エラー", description=f"対象のユーザーは`/receive_msg`が無効に設定されています", colour=embedColour.Error))
             return
+        if not await unit_exists(unit):
+            await interaction.edit_original_response(embed=unknown_unit_embed(unit))
+            return
         
-        vc_client = await VCClient()
+        vc_client = VCClient()
         claim_embed, new_claim = await create_claim_embed(vc_client, interaction.user.id, unit, amount, f"`/send_with_msg`による送信")
         await interaction.followup.send(embeds=[claim_embed])
 
@@ -177,28 +530,20 @@ async def send_with_msg(interaction:Interaction, unit:str, user:Member, amount:i
         
     except Exception as e:
         await interaction.edit_original_response(embed=Embed(title="内部エラー", description=f"{e.__class__.__name__}:\n{e}", colour=embedColour.Error))
-    finally:
-        cursor.close()
-        if vc_client: await vc_client.close()
 
 @app_commands.command(name="receive_msg",description="/send_with_msgの内容をDMで通知します")
 @app_commands.describe(receive_config="[True]DMを受け取る [False]DMを受け取らない")
 async def receive_msg(interaction:Interaction, receive_config:bool):
     await interaction.response.defer(thinking=True, ephemeral=True)
-    cursor = DBConnection.cursor()
     try:
         if receive_config:
-            cursor.execute("INSERT OR IGNORE INTO receive_msg (user_id) VALUES (?)", (interaction.user.id,))
+            await db.execute("INSERT OR IGNORE INTO receive_msg (user_id) VALUES (?)", (interaction.user.id,))
             await interaction.followup.send(embed=Embed(title="設定完了", description="/send_with_msgの内容がDMで通知されます", colour=embedColour.LightBlue))
         else:
-            cursor.execute("DELETE FROM receive_msg WHERE user_id = ?", (interaction.user.id,))
+            await db.execute("DELETE FROM receive_msg WHERE user_id = ?", (interaction.user.id,))
             await interaction.followup.send(embed=Embed(title="設定完了", description="/send_with_msgの内容はDMで通知されません", colour=embedColour.LightBlue))
-        DBConnection.commit()
     except Exception as e:
-        DBConnection.rollback()
         await interaction.edit_original_response(embed=Embed(title="内部エラー", description=f"{type(e).__name__}:\n{e}", colour=embedColour.Error))
-    finally:
-        cursor.close()
 
 # --- Reward Pool Commands ---
 
@@ -209,22 +554,37 @@ reward_pool = app_commands.Group(name="reward_pool", description="サーバー
 @app_commands.checks.has_permissions(manage_guild=True)
 async def reward_pool_init(interaction: Interaction, unit: str):
     await interaction.response.defer(thinking=True, ephemeral=True)
-    cursor = DBConnection.cursor()
-    vc_client = None
     try:
-        cursor.execute("SELECT * FROM reward_pools WHERE guild_id = ?", (interaction.guild_id,))
-        pool = RewardPool.from_dict(cursor.fetchone())
+        if not await unit_exists(unit):
+            await interaction.followup.send(embed=unknown_unit_embed(unit))
+            return
+
+        pool = RewardPool.from_dict(await db.fetchone("SELECT * FROM reward_pools WHERE guild_id = ?", (interaction.guild_id,)))
 
         if pool and pool.pool_balance > 0 and pool.unit != unit:
-                
-            vc_client = await VCClient()
-            await vc_client.pay(pool.unit, interaction.user.id, pool.pool_balance)
-                
-            cursor.execute(
-                "UPDATE reward_pools SET unit = ?, pool_balance = 0 WHERE guild_id = ?",
-                (unit, interaction.guild_id)
-            )
-            DBConnection.commit()
+            # 返金中に報酬で差し引かれた分を二重に払わないよう、先に残高を予約する
+            reserved, _ = await db.write(_reserve_pool, interaction.guild_id, pool.unit, pool.pool_balance)
+            if not reserved:
+                await reward_cache.reload_guild(db, interaction.guild_id)
+                await interaction.followup.send(embed=Embed(title="エラー", description="プール残高が変動しました。もう一度実行してください。", colour=embedColour.Error))
+                return
+
+            vc_client = VCClient()
+            try:
+                await vc_client.pay(pool.unit, interaction.user.id, pool.pool_balance)
+            except Exception as e:
+                if transfer_not_sent(e):
+                    await db.write(_release_pool, interaction.guild_id, pool.unit, pool.pool_balance)
+                else:
+                    # 返金された可能性があるので残高は戻さず、照合用に記録する
+                    await db.write(ledger.record, interaction.guild_id, interaction.user.id, ledger.UNCERTAIN, pool.unit, pool.pool_balance, int(time()))
+                    print(f"Refund of {pool.pool_balance} {pool.unit} to {interaction.user.id} in guild {interaction.guild_id} may have been sent: {e}")
+                raise
+            finally:
+                await reward_cache.reload_guild(db, interaction.guild_id)
+
+            await db.write(_switch_pool_unit, interaction.guild_id, interaction.user.id, pool.unit, pool.pool_balance, unit, int(time()))
+            await reward_cache.reload_guild(db, interaction.guild_id)
             
             success_embed = Embed(
                 title="処理完了",
@@ -234,19 +594,15 @@ async def reward_pool_init(interaction: Interaction, unit: str):
             await interaction.followup.send(embed=success_embed)
             return
 
-        cursor.execute(
+        await db.execute(
             "INSERT INTO reward_pools (guild_id, unit) VALUES (?, ?) ON CONFLICT(guild_id) DO UPDATE SET unit=excluded.unit",
             (interaction.guild_id, unit)
         )
-        DBConnection.commit()
+        await reward_cache.reload_guild(db, interaction.guild_id)
         await interaction.followup.send(embed=Embed(title="設定完了", description=f"報酬プールの通貨単位を **{unit}** に設定しました。", colour=embedColour.Success))
 
     except Exception as e:
-        DBConnection.rollback()
         await interaction.edit_original_response(content=None, embed=Embed(title="内部エラー", description=f"{type(e).__name__}:\n{e}", colour=embedColour.Error), view=None)
-    finally:
-        cursor.close()
-        if vc_client: await vc_client.close()
 
 @reward_pool.command(name="set", description="報酬ルールを追加または更新します (管理者向け)")
 @app_commands.describe(reward_type="報酬の種類 (例: message, voice_joinなど)", amount="報酬量", cooldown_seconds="次の報酬までの待機時間(秒)")
@@ -260,60 +616,50 @@ async def reward_pool_set(interaction: Interaction, reward_type: str, amount: in
         await interaction.followup.send(embed=Embed(title="エラー", description="無効な値です", colour=embedColour.Error))
         return
     
-    cursor = DBConnection.cursor()
     try:
-        cursor.execute("SELECT 1 FROM reward_pools WHERE guild_id = ?", (interaction.guild_id,))
-        if not cursor.fetchone():
+        if not await db.fetchone("SELECT 1 FROM reward_pools WHERE guild_id = ?", (interaction.guild_id,)):
             await interaction.followup.send(embed=Embed(title="エラー", description="先に`/reward_pool init`で通貨単位を設定してください。", colour=embedColour.Error))
             return
 
-        cursor.execute(
+        await db.execute(
             """
             INSERT INTO reward_configs (guild_id, reward_type, amount, cooldown_seconds) VALUES (?, ?, ?, ?)
             ON CONFLICT(guild_id, reward_type) DO UPDATE SET amount=excluded.amount, cooldown_seconds=excluded.cooldown_seconds
             """,
             (interaction.guild_id, reward_type.lower(), amount, cooldown_seconds)
         )
-        DBConnection.commit()
+        await reward_cache.reload_guild(db, interaction.guild_id)
+        await cooldown_index.reload_guild(db, int(time()), interaction.guild_id)
         embed = Embed(title="設定完了", description=f"報酬ルール **{reward_type.lower()}** を保存しました。", colour=embedColour.Success)
         embed.add_field(name="報酬量", value=str(amount))
         embed.add_field(name="クールダウン", value=f"{cooldown_seconds}秒")
         await interaction.followup.send(embed=embed)
     except Exception as e:
-        DBConnection.rollback()
         await interaction.followup.send(embed=Embed(title="内部エラー", description=f"{type(e).__name__}:\n{e}", colour=embedColour.Error))
-    finally:
-        cursor.close()
 
 @reward_pool.command(name="delete", description="報酬ルールを削除します (管理者向け)")
 @app_commands.describe(reward_type="削除する報酬の種類 (例: message)")
 @app_commands.checks.has_permissions(manage_guild=True)
 async def reward_pool_delete(interaction: Interaction, reward_type: str):
     await interaction.response.defer(thinking=True, ephemeral=True)
-    cursor = DBConnection.cursor()
     try:
-        cursor.execute(
+        deleted = await db.execute(
             "DELETE FROM reward_configs WHERE guild_id = ? AND reward_type = ?",
             (interaction.guild_id, reward_type.lower())
         )
-        if cursor.rowcount > 0:
-            DBConnection.commit()
+        if deleted > 0:
+            await reward_cache.reload_guild(db, interaction.guild_id)
             await interaction.followup.send(embed=Embed(title="削除完了", description=f"報酬ルール **{reward_type.lower()}** を削除しました。", colour=embedColour.Success))
         else:
             await interaction.followup.send(embed=Embed(title="エラー", description=f"報酬ルール **{reward_type.lower()}** は見つかりませんでした。", colour=embedColour.Error))
     except Exception as e:
-        DBConnection.rollback()
         await interaction.followup.send(embed=Embed(title="内部エラー", description=f"{type(e).__name__}:\n{e}", colour=embedColour.Error))
-    finally:
-        cursor.close()
 
 @reward_pool.command(name="info", description="報酬プールの現在の情報を表示します")
 async def reward_pool_info(interaction: Interaction):
     await interaction.response.defer(thinking=True)
-    cursor = DBConnection.cursor()
     try:
-        cursor.execute("SELECT * FROM reward_pools WHERE guild_id = ?", (interaction.guild_id,))
-        pool_dict = cursor.fetchone()
+        pool_dict = await db.fetchone("SELECT * FROM reward_pools WHERE guild_id = ?", (interaction.guild_id,))
         pool = RewardPool.from_dict(pool_dict)
 
         if not pool:
@@ -323,8 +669,7 @@ async def reward_pool_info(interaction: Interaction):
         embed = Embed(title="報酬プール情報", description=f"{interaction.guild.name}の現在の設定です。", colour=embedColour.LightBlue)
         embed.add_field(name="プール残高", value=f"{pool.pool_balance} {pool.unit}", inline=False)
         
-        cursor.execute("SELECT * FROM reward_configs WHERE guild_id = ?", (interaction.guild_id,))
-        configs = [RewardConfig.from_dict(c) for c in cursor.fetchall()]
+        configs = [RewardConfig.from_dict(c) for c in await db.fetchall("SELECT * FROM reward_configs WHERE guild_id = ?", (interaction.guild_id,))]
 
         if not configs:
             embed.add_field(name="報酬ルール", value="まだ設定されていません。", inline=False)
@@ -339,19 +684,36 @@ async def reward_pool_info(interaction: Interaction):
         await interaction.followup.send(embed=embed)
     except Exception as e:
         await interaction.followup.send(embed=Embed(title="内部エラー", description=f"{type(e).__name__}:\n{e}", colour=embedColour.Error))
-    finally:
-        cursor.close()
+
+@reward_pool.command(name="stats", description="報酬プールからの支払いと補充の集計を表示します")
+@app_commands.describe(days="集計する日数 (1〜30日、今日を含む)")
+async def reward_pool_stats(interaction: Interaction, days: app_commands.Range[int, 1, 30] = 7):
+    await interaction.response.defer(thinking=True)
+    try:
+        since = int(time()) - (days - 1) * ledger.SECONDS_PER_DAY
+        rows = await ledger.summary(db, interaction.guild_id, since)
+        if not rows:
+            await interaction.followup.send(embed=Embed(title="情報", description=f"過去{days}日間の記録はありません。", colour=embedColour.Yellow))
+            return
+
+        kind_names = {ledger.REWARD: "報酬", ledger.RAIN: "エアドロップ", ledger.DEPOSIT: "補充", ledger.REFUND: "返金", ledger.UNCERTAIN: "結果不明 (要確認)"}
+        embed = Embed(title="報酬プール統計", description=f"{interaction.guild.name}の過去{days}日間(UTC)の集計です。", colour=embedColour.LightBlue)
+        for row in rows:
+            name = kind_names.get(row['kind'], row['kind'])
+            if row['reward_type']:
+                name += f" (`{row['reward_type']}`)"
+            embed.add_field(name=name, value=f"{row['count']}件 / {row['amount']} {row['unit']}", inline=False)
+        await interaction.followup.send(embed=embed)
+    except Exception as e:
+        await interaction.followup.send(embed=Embed(title="内部エラー", description=f"{type(e).__name__}:\n{e}", colour=embedColour.Error))
 
 @reward_pool.command(name="deposit", description="報酬プールに通貨を補充します (管理者向け)")
 @app_commands.describe(amount="補充する数量")
 @app_commands.checks.has_permissions(manage_guild=True)
 async def reward_pool_deposit(interaction: Interaction, amount: int):
     await interaction.response.defer(thinking=True)
-    vc_client = None
-    cursor = DBConnection.cursor()
     try:
-        cursor.execute("SELECT * FROM reward_pools WHERE guild_id = ?", (interaction.guild_id,))
-        pool = RewardPool.from_dict(cursor.fetchone())
+        pool = RewardPool.from_dict(await db.fetchone("SELECT * FROM reward_pools WHERE guild_id = ?", (interaction.guild_id,)))
 
         if not pool:
             await interaction.edit_original_response(embed=Embed(title="エラー", description="先に`/reward_pool init`で報酬プールを設定してください。", colour=embedColour.Error))
@@ -362,15 +724,14 @@ async def reward_pool_deposit(interaction: Interaction, amount: int):
 
         initial_unit = pool.unit
         
-        vc_client = await VCClient()
+        vc_client = VCClient()
         claim_embed, new_claim = await create_claim_embed(vc_client, interaction.user.id, initial_unit, amount, f"報酬プールへの補充")
         await interaction.followup.send(embeds=[claim_embed])
 
         if not await wait_for_claim_approval(interaction, vc_client, new_claim, claim_embed):
             return
         
-        cursor.execute("SELECT unit FROM reward_pools WHERE guild_id = ?", (interaction.guild_id,))
-        current_pool_data = cursor.fetchone()
+        current_pool_data = await db.fetchone("SELECT unit FROM reward_pools WHERE guild_id = ?", (interaction.guild_id,))
         current_unit = current_pool_data['unit'] if current_pool_data else None
 
         if current_unit != initial_unit:
@@ -382,9 +743,13 @@ async def reward_pool_deposit(interaction: Interaction, amount: int):
             )
             try:
                 await vc_client.pay(initial_unit, interaction.user.id, amount)
+                await db.write(ledger.record, interaction.guild_id, interaction.user.id, ledger.REFUND, initial_unit, amount, int(time()))
                 refund_embed.color = embedColour.Success
                 refund_embed.title = "処理中断と返金完了"
             except Exception as e:
+                if not transfer_not_sent(e):
+                    await db.write(ledger.record, interaction.guild_id, interaction.user.id, ledger.UNCERTAIN, initial_unit, amount, int(time()))
+                    print(f"Refund of {amount} {initial_unit} to {interaction.user.id} in guild {interaction.guild_id} may have been sent: {e}")
                 refund_embed.color = embedColour.Error
                 refund_embed.title = "返金エラー"
                 refund_embed.add_field(name="エラー詳細", value=f"{type(e).__name__}: {e}")
@@ -392,22 +757,15 @@ async def reward_pool_deposit(interaction: Interaction, amount: int):
             await interaction.edit_original_response(embeds=[claim_embed, refund_embed])
             return
 
-        cursor.execute(
-            "UPDATE reward_pools SET pool_balance = pool_balance + ? WHERE guild_id = ?",
-            (amount, interaction.guild_id)
-        )
-        DBConnection.commit()
+        await db.write(_deposit_pool, interaction.guild_id, interaction.user.id, initial_unit, amount, int(time()))
+        await reward_cache.reload_guild(db, interaction.guild_id)
         
         confirm_embed = Embed(title="処理が完了しました", colour=embedColour.Success)
         confirm_embed.description = f"請求`{new_claim.id}`は承認され、プールに **{amount} {initial_unit}** が補充されました。"
         await interaction.edit_original_response(embeds=[claim_embed, confirm_embed])
 
     except Exception as e:
-        DBConnection.rollback()
         await interaction.edit_original_response(embed=Embed(title="内部エラー", description=f"{e.__class__.__name__}:\n{e}", colour=embedColour.Error))
-    finally:
-        cursor.close()
-        if vc_client: await vc_client.close()
 
 
 @reward_pool_init.error
@@ -422,68 +780,249 @@ async def rp_cmd_error(interaction: discord.Interaction, error: app_commands.App
 
 # --- Generic Reward Handler ---
 
-async def handle_reward(reward_type: str, user: discord.Member, guild: discord.Guild):
-    if user.bot:
-        return
+def _reserve_pool(cursor: sqlite3.Cursor, guild_id: int, unit: str, amount: int) -> tuple[bool, Optional[int]]:
+    """
+    プールの残高が足りる場合だけ`amount`を差し引きます。(予約できたか, 予約後の残高) を返します。
+    """
+    cursor.execute(
+        "UPDATE reward_pools SET pool_balance = pool_balance - ? WHERE guild_id = ? AND unit = ? AND pool_balance >= ?",
+        (amount, guild_id, unit, amount)
+    )
+    reserved = cursor.rowcount == 1
+    cursor.execute("SELECT pool_balance FROM reward_pools WHERE guild_id = ?", (guild_id,))
+    row = cursor.fetchone()
+    return reserved, row['pool_balance'] if row else None
 
-    cursor = DBConnection.cursor()
-    vc_client = None
+def _release_pool(cursor: sqlite3.Cursor, guild_id: int, unit: str, amount: int):
+    """
+    送金に失敗した予約分をプールに戻します。
+    """
+    cursor.execute(
+        "UPDATE reward_pools SET pool_balance = pool_balance + ? WHERE guild_id = ? AND unit = ?",
+        (amount, guild_id, unit)
+    )
+
+def _switch_pool_unit(cursor: sqlite3.Cursor, guild_id: int, user_id: int, old_unit: str, refunded: int, unit: str, now: int):
+    ledger.record(cursor, guild_id, user_id, ledger.REFUND, old_unit, refunded, now)
+    cursor.execute("UPDATE reward_pools SET unit = ? WHERE guild_id = ?", (unit, guild_id))
+
+def _deposit_pool(cursor: sqlite3.Cursor, guild_id: int, user_id: int, unit: str, amount: int, now: int):
+    ledger.record(cursor, guild_id, user_id, ledger.DEPOSIT, unit, amount, now)
+    cursor.execute("UPDATE reward_pools SET pool_balance = pool_balance + ? WHERE guild_id = ?", (amount, guild_id))
+
+def _commit_reward(cursor: sqlite3.Cursor, settler: Optional[RewardSettler], guild_id: int, user_id: int, reward_type: str, unit: str, amount: int, now: int,
+                   kind: str = ledger.REWARD) -> bool:
+    settle_now = settler.accrue(cursor, guild_id, user_id, unit, amount) if settler else False
+    ledger.record(cursor, guild_id, user_id, kind, unit, amount, now, reward_type)
+    cursor.execute(
+        """
+        INSERT INTO user_reward_cooldowns (user_id, guild_id, reward_type, last_triggered_timestamp) VALUES (?, ?, ?, ?)
+        ON CONFLICT(user_id, guild_id, reward_type) DO UPDATE SET last_triggered_timestamp=excluded.last_triggered_timestamp
+        """,
+        (user_id, guild_id, reward_type, now)
+    )
+    return settle_now
+
+def _accrue_reward(cursor: sqlite3.Cursor, settler: RewardSettler, guild_id: int, user_id: int, reward_type: str, unit: str, amount: int, now: int) -> tuple[bool, Optional[int], bool]:
+    """
+    積み立てモードでは予約と積み立てを1つのトランザクションで行います。
+    """
+    reserved, balance = _reserve_pool(cursor, guild_id, unit, amount)
+    settle_now = reserved and _commit_reward(cursor, settler, guild_id, user_id, reward_type, unit, amount, now)
+    return reserved, balance, settle_now
+
+def _outcome(reward_type: str, outcome: str) -> str:
+    metrics.reward_outcomes.inc(reward_type, outcome)
+    return outcome
+
+shutting_down = False
+_rewards_in_flight = 0
+_rewards_idle = asyncio.Event()
+_rewards_idle.set()
+
+async def begin_shutdown():
+    """
+    ゲートウェイのイベントによる報酬とボイスの記録を止め、処理中の報酬が終わるまで待ちます。
+    送金クライアントやデータベースなどを止める前に呼び出してください。
+    """
+    global shutting_down
+    shutting_down = True
+    await _rewards_idle.wait()
+
+async def handle_reward(reward_type: str, user: discord.Member, guild: discord.Guild, quantity: int = 1) -> Optional[str]:
+    """
+    ゲートウェイのイベントから報酬を与えます。`begin_shutdown`の後は何もせずNoneを返します。
+    """
+    global _rewards_in_flight
+    if shutting_down:
+        return None
+    _rewards_in_flight += 1
+    _rewards_idle.clear()
     try:
-        cursor.execute("SELECT * FROM reward_configs WHERE guild_id = ? AND reward_type = ?", (guild.id, reward_type))
-        config = RewardConfig.from_dict(cursor.fetchone())
-        if not config: return
+        return await _give_reward(reward_type, user, guild, quantity)
+    finally:
+        _rewards_in_flight -= 1
+        if _rewards_in_flight == 0:
+            _rewards_idle.set()
 
-        cursor.execute("SELECT * FROM reward_pools WHERE guild_id = ?", (guild.id,))
-        pool = RewardPool.from_dict(cursor.fetchone())
-        if not pool or pool.pool_balance < config.amount:
-            return
+async def _give_reward(reward_type: str, user: discord.Member, guild: discord.Guild, quantity: int = 1) -> Optional[str]:
+    """
+    報酬ルールの`quantity`倍の報酬を与え、結果("paid", "accrued", "cooldown"など)を返します。
+    """
+    if user.bot:
+        return None
 
-        current_time = int(time())
-        cursor.execute(
-            "SELECT * FROM user_reward_cooldowns WHERE user_id = ? AND guild_id = ? AND reward_type = ?",
-            (user.id, guild.id, reward_type)
-        )
-        cooldown_data = UserRewardCooldown.from_dict(cursor.fetchone())
+    config = reward_cache.get_config(guild.id, reward_type)
+    if not config:
+        return _outcome(reward_type, "no_config")
 
-        if cooldown_data and (current_time - cooldown_data.last_triggered_timestamp) < config.cooldown_seconds:
-            return
-        
-        vc_client = await VCClient()
-        await vc_client.pay(pool.unit, user.id, config.amount)
+    amount = config.amount * quantity
+    pool = reward_cache.get_pool(guild.id)
+    if not pool or pool.pool_balance < amount:
+        return _outcome(reward_type, "pool_empty")
 
-        cursor.execute(
-            "UPDATE reward_pools SET pool_balance = pool_balance - ? WHERE guild_id = ?",
-            (config.amount, guild.id)
-        )
-        cursor.execute(
-            """
-            INSERT INTO user_reward_cooldowns (user_id, guild_id, reward_type, last_triggered_timestamp) VALUES (?, ?, ?, ?)
-            ON CONFLICT(user_id, guild_id, reward_type) DO UPDATE SET last_triggered_timestamp=excluded.last_triggered_timestamp
-            """,
-            (user.id, guild.id, reward_type, current_time)
-        )
-        DBConnection.commit()
-        # print(f"[Guild_{guild.id}] Rewarded {config.amount} {pool.unit} to {user.name} for '{reward_type}'.")
+    current_time = int(time())
+    if cooldown_index.on_cooldown(guild.id, user.id, reward_type, current_time, config.cooldown_seconds):
+        return _outcome(reward_type, "cooldown")
+
+    # 送金中に同じユーザーの報酬が重複しないよう先にクールダウンを記録する
+    cooldown_index.touch(guild.id, user.id, reward_type, current_time, config.cooldown_seconds)
+    settler = reward_settler
+    paid = False
+    try:
+        # クライアントが使えない場合は予約する前に失敗させる
+        vc_client = VCClient() if settler is None else None
+        if settler is not None:
+            # 予約と積み立ては1つの書き込みなので、キャンセルされても差し引いた分は積み立てに残る
+            reserved, balance, settle_now = await db.write(_accrue_reward, settler, guild.id, user.id, reward_type, pool.unit, amount, current_time)
+        else:
+            reservation = asyncio.ensure_future(db.write(_reserve_pool, guild.id, pool.unit, amount))
+            try:
+                reserved, balance = await asyncio.shield(reservation)
+            except asyncio.CancelledError:
+                # 送金は始めていないので、予約が確定していれば戻す
+                await asyncio.wait([reservation])
+                if reservation.exception() is None and reservation.result()[0]:
+                    await db.write(_release_pool, guild.id, pool.unit, amount)
+                cooldown_index.clear(guild.id, user.id, reward_type)
+                raise
+        if balance is not None:
+            reward_cache.set_balance(guild.id, balance)
+        if not reserved:
+            cooldown_index.clear(guild.id, user.id, reward_type)
+            return _outcome(reward_type, "pool_empty")
+
+        if settler is None:
+            try:
+                await vc_client.pay(pool.unit, user.id, amount)
+            except asyncio.CancelledError:
+                # 送金の途中でキャンセルされた場合は送金された可能性があるので、照合用に記録してから中断する
+                paid = True
+                await db.write(_commit_reward, None, guild.id, user.id, reward_type, pool.unit, amount, current_time, ledger.UNCERTAIN)
+                print(f"Reward of {amount} {pool.unit} to {user.id} in '{guild.name}' was cancelled while sending")
+                metrics.reward_outcomes.inc(reward_type, "uncertain")
+                raise
+            except Exception as e:
+                if transfer_not_sent(e):
+                    await db.write(_release_pool, guild.id, pool.unit, amount)
+                    reward_cache.adjust_balance(guild.id, amount)
+                    raise
+                # 送金された可能性があるので、予約分とクールダウンは戻さずに照合用に記録する
+                paid = True
+                await db.write(_commit_reward, None, guild.id, user.id, reward_type, pool.unit, amount, current_time, ledger.UNCERTAIN)
+                print(f"Reward of {amount} {pool.unit} to {user.id} in '{guild.name}' may have been sent: {e}")
+                return _outcome(reward_type, "uncertain")
+            paid = True
+            settle_now = await db.write(_commit_reward, None, guild.id, user.id, reward_type, pool.unit, amount, current_time)
+
+        if settle_now:
+            settler.wake()
+        # print(f"[Guild_{guild.id}] Rewarded {amount} {pool.unit} to {user.name} for '{reward_type}'.")
+        return _outcome(reward_type, "accrued" if settler else "paid")
 
     except Exception as e:
-        DBConnection.rollback()
+        if not paid:
+            cooldown_index.clear(guild.id, user.id, reward_type)
         print(f"Error in handle_reward for '{reward_type}' in '{guild.name}': {e}")
-    finally:
-        cursor.close()
-        if vc_client: await vc_client.close()
+        return _outcome(reward_type, "error")
+
+def _in_rewarded_voice(member: discord.Member, state: discord.VoiceState) -> bool:
+    return state.channel is not None and state.channel != member.guild.afk_channel
+
+async def handle_voice_state(member: discord.Member, before: discord.VoiceState, after: discord.VoiceState):
+    """
+    ボイスチャンネルへの参加と退出を記録します。退出時にそれまでの分数を精算します。
+    """
+    if member.bot or voice_sessions is None or shutting_down:
+        return
+    was_in = _in_rewarded_voice(member, before)
+    is_in = _in_rewarded_voice(member, after)
+    if is_in and not was_in:
+        if reward_cache.get_config(member.guild.id, config.Voice.reward_type):
+            voice_sessions.join(member)
+    elif was_in and not is_in:
+        await voice_sessions.leave(member)
 
 # --- Admin Commands ---
 
+def cached_member_count(guilds: list[discord.Guild]) -> int:
+    return sum(len(guild.members) for guild in guilds)
+
+def memory_usage_text(guilds: list[discord.Guild]) -> str:
+    rss = metrics.resident_memory_bytes()
+    usage = f"{rss / 1024 / 1024:.1f}MiB" if rss is not None else "不明"
+    return f"{usage} (メンバーキャッシュ: {config.Discord.member_cache}, キャッシュ中のメンバー: {cached_member_count(guilds)}人, サーバー数: {len(guilds)})"
+
 def is_admin(interaction: discord.Interaction) -> bool:
     return interaction.user.id in config.Discord.ADMIN
 
-@app_commands.command(name="refresh", description=f"[デバッグ用] 空コマンド [{int(time())}]")
+@app_commands.command(name="refresh", description="[デバッグ用] 空コマンド")
 @app_commands.check(is_admin)
 async def admin_refresh(interaction: discord.Interaction):
     await interaction.response.defer(thinking=True, ephemeral=True)
     await interaction.followup.send(content=str(int(time())))
 
+@app_commands.command(name="stats", description="[デバッグ用] 内部キャッシュの統計を表示します")
+@app_commands.check(is_admin)
+async def admin_stats(interaction: discord.Interaction):
+    await interaction.response.defer(thinking=True, ephemeral=True)
+    embed = Embed(title="統計情報", colour=embedColour.Gray)
+    cache_stats = reward_cache.stats()
+    currency_stats = currency_cache.stats() if currency_cache else None
+    embed.add_field(
+        name="報酬設定キャッシュ",
+        value=f"サーバー数: {cache_stats['guilds']}\n"
+              f"ルール数: {cache_stats['configs']}\n"
+              f"ヒット: {cache_stats['hits']} ({cache_stats['hit_rate']:.1%})\n"
+              f"ミス: {cache_stats['misses']} ({cache_stats['miss_rate']:.1%})",
+        inline=False
+    )
+    embed.add_field(name="クールダウン中のエントリ", value=str(len(cooldown_index)), inline=False)
+    embed.add_field(name="メモリ使用量", value=memory_usage_text(interaction.client.guilds), inline=False)
+    if voice_sessions is not None:
+        embed.add_field(name="ボイスセッション", value=str(len(voice_sessions)), inline=False)
+    if _vc_client is not None:
+        rate_stats = _vc_client.rate_limiter.stats()
+        embed.add_field(
+            name="APIレート制限",
+            value=f"リクエスト数: {rate_stats['acquired']}\n"
+                  f"429応答: {rate_stats['throttled']}\n"
+                  f"平均待機: {rate_stats['average_wait'] * 1000:.1f}ms\n"
+                  f"最大待機: {rate_stats['max_wait'] * 1000:.1f}ms",
+            inline=False
+        )
+    if currency_stats:
+        embed.add_field(
+            name="通貨情報キャッシュ",
+            value=f"エントリ数: {currency_stats['entries']}\n"
+                  f"ヒット: {currency_stats['hits']} ({currency_stats['hit_rate']:.1%})\n"
+                  f"ミス: {currency_stats['misses']}",
+            inline=False
+        )
+    await interaction.followup.send(embed=embed)
+
 @admin_refresh.error
+@admin_stats.error
 async def admin_cmd_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
     if isinstance(error, app_commands.CheckFailure):
         await interaction.response.send_message("このコマンドは管理者のみ実行できます。", ephemeral=True)
@@ -0,0 +1,94 @@
+import asyncio
+from time import monotonic
+from typing import Optional
+
+from virtualcrypto import AsyncVirtualCryptoClient, Claim, ClaimStatus
+
+
+class ClaimWatcher:
+    """
+    待機中の請求をまとめて監視し、状態が変わった時点で待機中のコマンドを再開させます。
+    `get_claims()`で保留中の請求を一括取得し、一覧から消えた請求だけを個別に確認します。
+    作成直後の請求は短い間隔で、時間が経った請求は長い間隔で確認します。
+    """
+    def __init__(self, vc_client: AsyncVirtualCryptoClient, timeout: float = 120,
+                 fast_interval: float = 2, slow_interval: float = 10, fast_period: float = 30):
+        self.vc_client = vc_client
+        self.timeout = timeout
+        self.fast_interval = fast_interval
+        self.slow_interval = slow_interval
+        self.fast_period = fast_period
+        self._waiters: dict[int, tuple[float, asyncio.Future]] = {}
+        self._added: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def wait(self, claim_id: int) -> Optional[Claim]:
+        """
+        請求が保留中でなくなるまで待ち、最新のClaimを返します。
+        タイムアウトした場合はNoneを返します。
+        """
+        if claim_id in self._waiters:
+            future = self._waiters[claim_id][1]
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self._waiters[claim_id] = (monotonic(), future)
+            if self._added is None:
+                self._added = asyncio.Event()
+            self._added.set()
+            if self._task is None or self._task.done():
+                self._task = asyncio.create_task(self._run())
+        return await asyncio.shield(future)
+
+    def _next_interval(self, now: float) -> float:
+        youngest = min(now - created for created, _ in self._waiters.values())
+        return self.fast_interval if youngest < self.fast_period else self.slow_interval
+
+    def _resolve(self, claim_id: int, claim: Optional[Claim]):
+        _, future = self._waiters.pop(claim_id)
+        if not future.done():
+            future.set_result(claim)
+
+    async def _refresh(self, claim_id: int):
+        try:
+            claim = await self.vc_client.get_claim(claim_id)
+        except Exception as e:
+            print(f"Error in claim watcher for {claim_id}: {e}")
+            return
+        if claim.status != ClaimStatus.Pending and claim_id in self._waiters:
+            self._resolve(claim_id, claim)
+
+    async def _run(self):
+        while self._waiters:
+            self._added.clear()
+            try:
+                await asyncio.wait_for(self._added.wait(), timeout=self._next_interval(monotonic()))
+                # 新しい請求は作成直後なので短い間隔で確認する
+                await asyncio.sleep(self.fast_interval)
+            except asyncio.TimeoutError:
+                pass
+
+            try:
+                pending_ids = {claim.id for claim in await self.vc_client.get_claims()}
+            except Exception as e:
+                print(f"Error in claim watcher: {e}")
+                pending_ids = None
+
+            if pending_ids is not None:
+                changed = [claim_id for claim_id in self._waiters if claim_id not in pending_ids]
+                await asyncio.gather(*(self._refresh(claim_id) for claim_id in changed))
+
+            now = monotonic()
+            for claim_id, (created, _) in list(self._waiters.items()):
+                if now - created >= self.timeout:
+                    self._resolve(claim_id, None)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for claim_id in list(self._waiters):
+            self._resolve(claim_id, None)
@@ -0,0 +1,88 @@
+import asyncio
+import sqlite3
+from time import time
+from typing import Callable, Optional
+
+from database import Database
+from idempotency import SQLiteIdempotencyStore
+
+
+class CooldownCompactor:
+    """
+    クールダウンが明けてから時間が経った`user_reward_cooldowns`の行を定期的に削除します。
+    サーバーの報酬ルールの中で最も長いクールダウンより古い行が対象です。
+    `idempotency_store`を指定した場合は、`idempotency_ttl`秒より古い送金の冪等キーも同じ間隔で削除します。
+    書き込みロックを長く持たないよう、`batch_size`行ずつ間隔を空けて削除します。
+    """
+    def __init__(self, db: Database, interval: float = 3600, batch_size: int = 500, pause: float = 0.05,
+                 idempotency_store: Optional[SQLiteIdempotencyStore] = None, idempotency_ttl: int = 604800):
+        self.db = db
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self.idempotency_store = idempotency_store
+        self.idempotency_ttl = idempotency_ttl
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _delete_batch(cursor: sqlite3.Cursor, now: int, limit: int) -> int:
+        cursor.execute(
+            """
+            DELETE FROM user_reward_cooldowns WHERE rowid IN (
+                SELECT c.rowid FROM user_reward_cooldowns c
+                LEFT JOIN (
+                    SELECT guild_id, MAX(cooldown_seconds) AS max_cooldown FROM reward_configs GROUP BY guild_id
+                ) r ON r.guild_id = c.guild_id
+                WHERE c.last_triggered_timestamp + COALESCE(r.max_cooldown, 0) <= ?
+                LIMIT ?
+            )
+            """,
+            (now, limit)
+        )
+        return cursor.rowcount
+
+    async def compact(self) -> int:
+        """
+        対象の行がなくなるまで削除を繰り返し、削除した行数を返します。
+        """
+        now = int(time())
+        removed = 0
+        while True:
+            deleted = await self.db.write(self._delete_batch, now, self.batch_size)
+            removed += deleted
+            if deleted < self.batch_size:
+                return removed
+            await asyncio.sleep(self.pause)
+
+    async def prune_transfers(self) -> int:
+        if self.idempotency_store is None:
+            return 0
+        return await self.idempotency_store.prune(self.idempotency_ttl, self.batch_size, self.pause)
+
+    async def _run(self, on_compacted: Optional[Callable[[int, int], None]]):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                removed = await self.compact()
+                pruned = await self.prune_transfers()
+            except Exception as e:
+                print(f"Error in cooldown compaction: {e}")
+                continue
+            if on_compacted:
+                on_compacted(removed, pruned)
+
+    def start(self, on_compacted: Optional[Callable[[int, int], None]] = None):
+        """
+        `interval`秒ごとに`compact`と`prune_transfers`を実行し、削除した行数を`on_compacted`に渡します。
+        """
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(on_compacted))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
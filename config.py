@@ -2,7 +2,64 @@ class VirtualCrypto:
     client_id:str = "CLIENT_ID"
     client_secret:str = "CLIENT_SECRET"
     public_key:str = "PUB_KEY"
+    connection_limit:int = 100
+    dns_cache_ttl:int = 300
+    keepalive_timeout:float = 30.0
+    currency_cache_ttl:float = 600
+    currency_cache_size:int = 1024
+    rate_limit:float = 10
+    rate_burst:int = 10
+    request_timeout:float = 10.0
+    max_retries:int = 2
+    retry_backoff:float = 0.5
+    hedge_delay:float = 2.0
+    idempotency_ttl:int = 604800
+    token_refresh_margin:float = 60
+    token_cache_path:str = "vc_token.json"
+
+class ClaimWatch:
+    timeout:float = 120
+    fast_interval:float = 2
+    slow_interval:float = 10
+    fast_period:float = 30
+
+class Payout:
+    concurrency:int = 8
+    batch_size:int = 500
+
+class Reward:
+    settle_mode:bool = False
+    settle_interval:int = 60
+    settle_threshold:int = 100
+
+class CooldownCompaction:
+    interval:float = 3600
+    batch_size:int = 500
+    pause:float = 0.05
+
+class Voice:
+    reward_type:str = "voice"
+    checkpoint_interval:float = 300
+
+class Database:
+    path:str = "database.db"
+    read_threads:int = 2
+    commit_window:float = 0.002
+
+class Sharding:
+    shard_count:int = 1
+    processes:list[list[int]] = [[0]]
+
+class Metrics:
+    enabled:bool = False
+    host:str = "127.0.0.1"
+    port:int = 9100
 
 class Discord:
     BOT_TOKEN:str = "BOT_TOKEN"
     ADMIN:list[int] = []
+    intents_members:bool = True
+    intents_presences:bool = False
+    intents_message_content:bool = True
+    # "all": 全メンバーをキャッシュ, "voice": ボイスチャンネルにいるメンバーだけ, "none": キャッシュしない
+    member_cache:str = "voice"
@@ -0,0 +1,83 @@
+import asyncio
+from collections import OrderedDict
+from time import monotonic
+from typing import Awaitable, Callable, Optional
+
+from virtualcrypto import AsyncVirtualCryptoClient, Currency
+
+
+class CurrencyCache:
+    """
+    通貨情報のTTL付きLRUキャッシュです。
+    同じ通貨の問い合わせが同時に来た場合は1回のリクエストにまとめます。
+    存在しない通貨は`negative_ttl`秒だけ記録します。
+    """
+    def __init__(self, vc_client: AsyncVirtualCryptoClient, ttl: float = 600, negative_ttl: float = 30, max_size: int = 1024):
+        self.vc_client = vc_client
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._entries: OrderedDict[tuple, tuple[float, Optional[Currency]]] = OrderedDict()
+        self._inflight: dict[tuple, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def _get(self, key: tuple, fetch: Callable[[], Awaitable[Optional[Currency]]]) -> Optional[Currency]:
+        entry = self._entries.get(key)
+        if entry and entry[0] > monotonic():
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        while (future := self._inflight.get(key)) is not None:
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # 取得していたタスクがキャンセルされた場合は、待っていたタスクが取得し直す
+                if not future.cancelled():
+                    raise
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            currency = await fetch()
+        except Exception as e:
+            future.set_exception(e)
+            # 待機しているタスクがいない場合の未取得例外の警告を避ける
+            future.exception()
+            raise
+        else:
+            future.set_result(currency)
+            self._store(key, currency)
+            return currency
+        finally:
+            # キャンセルされた場合も待機しているタスクが止まったままにならないようにする
+            if not future.done():
+                future.cancel()
+            del self._inflight[key]
+
+    def _store(self, key: tuple, currency: Optional[Currency]):
+        ttl = self.ttl if currency else self.negative_ttl
+        self._entries[key] = (monotonic() + ttl, currency)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def get_by_unit(self, unit: str) -> Optional[Currency]:
+        return await self._get(("unit", unit), lambda: self.vc_client.get_currency_by_unit(unit))
+
+    async def get_by_guild(self, guild_id: int) -> Optional[Currency]:
+        return await self._get(("guild", guild_id), lambda: self.vc_client.get_currency_by_guild(guild_id))
+
+    async def get_by_name(self, name: str) -> Optional[Currency]:
+        return await self._get(("name", name), lambda: self.vc_client.get_currency_by_name(name))
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0
+        }
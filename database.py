@@ -0,0 +1,206 @@
+import asyncio
+import queue
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, perf_counter
+from typing import Any, Callable, Optional
+
+
+def dict_factory(cursor, row):
+    d = {}
+    for idx, col in enumerate(cursor.description):
+        d[col[0]] = row[idx]
+    return d
+
+
+def statement_kind(sql: str) -> str:
+    return sql.split(None, 1)[0].lower() if sql.strip() else "empty"
+
+
+def connect(path: str) -> sqlite3.Connection:
+    """
+    WALモードを有効にしたSQLiteの接続を作成します。
+    """
+    connection = sqlite3.connect(path, check_same_thread=False)
+    connection.row_factory = dict_factory
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute("PRAGMA busy_timeout=5000")
+    return connection
+
+
+class Database:
+    """
+    SQLiteへのアクセスをイベントループの外で実行します。
+    読み込みは小さなスレッドプールで、書き込みは専用の書き込みスレッドで行い、
+    短い間隔の中で届いた書き込みは1回のコミットにまとめます。
+    """
+    def __init__(self, path: str, read_threads: int = 2, commit_window: float = 0.002,
+                 observer: Optional[Callable[[str, float], None]] = None):
+        self.path = path
+        self.observer = observer
+        self.commit_window = commit_window
+        self._read_threads = read_threads
+        self._read_pool: Optional[ThreadPoolExecutor] = None
+        self._read_local = threading.local()
+        self._read_connections: list[sqlite3.Connection] = []
+        self._writes: queue.Queue = queue.Queue()
+        self._writer: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._closed = False
+
+    def _ensure_started(self):
+        # 閉じた後や閉じている途中に使われた場合は、新しいスレッドを起動したり
+        # 停止する書き込みスレッドに書き込みを渡したりせずに失敗させる
+        if self._closed:
+            raise RuntimeError("database is closed")
+        if self._writer is not None:
+            return
+        with self._start_lock:
+            if self._closed:
+                raise RuntimeError("database is closed")
+            if self._writer is None:
+                self._read_pool = ThreadPoolExecutor(max_workers=self._read_threads, thread_name_prefix="db-read")
+                writer = threading.Thread(target=self._write_loop, name="db-write", daemon=True)
+                writer.start()
+                self._writer = writer
+
+    # --- Read ---
+
+    def _read_connection(self) -> sqlite3.Connection:
+        connection = getattr(self._read_local, "connection", None)
+        if connection is None:
+            connection = connect(self.path)
+            self._read_local.connection = connection
+            self._read_connections.append(connection)
+        return connection
+
+    def _run_read(self, fn: Callable, args: tuple):
+        cursor = self._read_connection().cursor()
+        try:
+            return fn(cursor, *args)
+        finally:
+            cursor.close()
+
+    async def _read(self, kind: str, fn: Callable[..., Any], args: tuple) -> Any:
+        self._ensure_started()
+        start = perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._read_pool, self._run_read, fn, args)
+        finally:
+            if self.observer:
+                self.observer(kind, perf_counter() - start)
+
+    async def read(self, fn: Callable[..., Any], *args) -> Any:
+        """
+        `fn(cursor, *args)`を読み込み用スレッドで実行し、その戻り値を返します。
+        """
+        return await self._read(fn.__name__, fn, args)
+
+    async def fetchone(self, sql: str, params: tuple = ()) -> Optional[dict]:
+        return await self._read(statement_kind(sql), lambda cursor: cursor.execute(sql, params).fetchone(), ())
+
+    async def fetchall(self, sql: str, params: tuple = ()) -> list[dict]:
+        return await self._read(statement_kind(sql), lambda cursor: cursor.execute(sql, params).fetchall(), ())
+
+    # --- Write ---
+
+    async def _write(self, kind: str, fn: Callable[..., Any], args: tuple) -> Any:
+        self._ensure_started()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        start = perf_counter()
+        self._writes.put((fn, args, future, loop))
+        try:
+            return await future
+        finally:
+            if self.observer:
+                self.observer(kind, perf_counter() - start)
+
+    async def write(self, fn: Callable[..., Any], *args) -> Any:
+        """
+        `fn(cursor, *args)`を書き込みスレッドで1つのトランザクションとして実行し、
+        コミットが完了してから戻り値を返します。例外が発生した場合はその分だけロールバックされます。
+        """
+        return await self._write(fn.__name__, fn, args)
+
+    async def execute(self, sql: str, params: tuple = ()) -> int:
+        """
+        1つの書き込みクエリを実行し、変更された行数を返します。
+        """
+        return await self._write(statement_kind(sql), lambda cursor: cursor.execute(sql, params).rowcount, ())
+
+    def _collect_batch(self, first) -> tuple[list, bool]:
+        batch = [first]
+        deadline = monotonic() + self.commit_window
+        while True:
+            timeout = deadline - monotonic()
+            try:
+                item = self._writes.get(timeout=timeout) if timeout > 0 else self._writes.get_nowait()
+            except queue.Empty:
+                return batch, False
+            if item is None:
+                return batch, True
+            batch.append(item)
+
+    def _write_loop(self):
+        connection = connect(self.path)
+        connection.isolation_level = None
+        stop = False
+        while not stop:
+            first = self._writes.get()
+            if first is None:
+                break
+            batch, stop = self._collect_batch(first)
+
+            results = []
+            cursor = connection.cursor()
+            try:
+                cursor.execute("BEGIN IMMEDIATE")
+                for fn, args, future, loop in batch:
+                    cursor.execute("SAVEPOINT write")
+                    try:
+                        results.append((future, loop, fn(cursor, *args), None))
+                        cursor.execute("RELEASE write")
+                    except Exception as e:
+                        cursor.execute("ROLLBACK TO write")
+                        cursor.execute("RELEASE write")
+                        results.append((future, loop, None, e))
+                cursor.execute("COMMIT")
+            except Exception as e:
+                if connection.in_transaction:
+                    connection.execute("ROLLBACK")
+                results = [(future, loop, None, e) for _, _, future, loop in batch]
+            finally:
+                cursor.close()
+
+            for future, loop, result, error in results:
+                loop.call_soon_threadsafe(_resolve, future, result, error)
+        connection.close()
+
+    async def close(self):
+        """
+        書き込みスレッドと読み込み用スレッドを停止します。閉じた後の読み書きは`RuntimeError`になります。
+        """
+        with self._start_lock:
+            self._closed = True
+        if self._writer is None:
+            return
+        self._writes.put(None)
+        await asyncio.get_running_loop().run_in_executor(None, self._writer.join)
+        self._writer = None
+        self._read_pool.shutdown(wait=True)
+        self._read_pool = None
+        for connection in self._read_connections:
+            connection.close()
+        self._read_connections.clear()
+
+
+def _resolve(future: asyncio.Future, result: Any, error: Optional[Exception]):
+    if future.cancelled():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
@@ -0,0 +1,81 @@
+import asyncio
+import sqlite3
+from time import time
+from typing import Optional
+
+from virtualcrypto import IdempotencyStore
+from virtualcrypto.idempotency import SENDING, SENT, FAILED
+from database import Database
+
+
+class SQLiteIdempotencyStore(IdempotencyStore):
+    """
+    送金ごとの冪等キーと状態を`transfer_idempotency`に保存します。
+    再起動後も同じキーの送金が二重に行われないようにします。
+    """
+    def __init__(self, db: Database):
+        self.db = db
+
+    @staticmethod
+    def create_table(cursor: sqlite3.Cursor):
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS transfer_idempotency (
+                key TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                updated_at INTEGER NOT NULL
+            )
+        """)
+
+    @staticmethod
+    def _begin(cursor: sqlite3.Cursor, key: str, now: int) -> Optional[str]:
+        cursor.execute("SELECT state FROM transfer_idempotency WHERE key = ?", (key,))
+        row = cursor.fetchone()
+        if row and row['state'] != FAILED:
+            return row['state']
+        cursor.execute(
+            """
+            INSERT INTO transfer_idempotency (key, state, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET state=excluded.state, updated_at=excluded.updated_at
+            """,
+            (key, SENDING, now)
+        )
+        return None
+
+    @staticmethod
+    def _finish(cursor: sqlite3.Cursor, key: str, state: str, now: int):
+        cursor.execute(
+            "UPDATE transfer_idempotency SET state = ?, updated_at = ? WHERE key = ?",
+            (state, now, key)
+        )
+
+    @staticmethod
+    def _prune(cursor: sqlite3.Cursor, before: int, limit: int) -> int:
+        cursor.execute(
+            """
+            DELETE FROM transfer_idempotency WHERE rowid IN (
+                SELECT rowid FROM transfer_idempotency WHERE state IN (?, ?) AND updated_at < ? LIMIT ?
+            )
+            """,
+            (SENT, FAILED, before, limit)
+        )
+        return cursor.rowcount
+
+    async def begin(self, key: str) -> Optional[str]:
+        return await self.db.write(self._begin, key, int(time()))
+
+    async def finish(self, key: str, state: str):
+        await self.db.write(self._finish, key, state, int(time()))
+
+    async def prune(self, max_age: int, batch_size: int = 500, pause: float = 0.05) -> int:
+        """
+        `max_age`秒より前に結果が確定したキーを`batch_size`件ずつ削除し、削除した件数を返します。
+        結果が分からないキーは照合のために残します。
+        """
+        before = int(time()) - max_age
+        removed = 0
+        while True:
+            deleted = await self.db.write(self._prune, before, batch_size)
+            removed += deleted
+            if deleted < batch_size:
+                return removed
+            await asyncio.sleep(pause)
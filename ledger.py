@@ -0,0 +1,73 @@
+import sqlite3
+
+from database import Database
+
+SECONDS_PER_DAY = 86400
+
+# 送金の種類
+REWARD = "reward"
+RAIN = "rain"
+DEPOSIT = "deposit"
+REFUND = "refund"
+# 送金されたか分からず、手動での照合が必要なもの
+UNCERTAIN = "uncertain"
+
+
+def create_table(cursor: sqlite3.Cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS payout_ledger (
+            entry_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            guild_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            reward_type TEXT NOT NULL DEFAULT '',
+            unit TEXT NOT NULL,
+            amount INTEGER NOT NULL,
+            created_at INTEGER NOT NULL
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS payout_rollups (
+            guild_id INTEGER NOT NULL,
+            day INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            reward_type TEXT NOT NULL,
+            unit TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            PRIMARY KEY (guild_id, day, kind, reward_type, unit)
+        )
+    """)
+
+
+def record(cursor: sqlite3.Cursor, guild_id: int, user_id: int, kind: str, unit: str, amount: int, now: int, reward_type: str = ""):
+    """
+    呼び出し元のトランザクション内で台帳に1件追記し、日別の集計を更新します。
+    台帳の行は更新も削除もしません。
+    """
+    cursor.execute(
+        "INSERT INTO payout_ledger (guild_id, user_id, kind, reward_type, unit, amount, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (guild_id, user_id, kind, reward_type, unit, amount, now)
+    )
+    cursor.execute(
+        """
+        INSERT INTO payout_rollups (guild_id, day, kind, reward_type, unit, count, amount) VALUES (?, ?, ?, ?, ?, 1, ?)
+        ON CONFLICT(guild_id, day, kind, reward_type, unit) DO UPDATE SET count = count + 1, amount = amount + excluded.amount
+        """,
+        (guild_id, now // SECONDS_PER_DAY, kind, reward_type, unit, amount)
+    )
+
+
+async def summary(db: Database, guild_id: int, since: int) -> list[dict]:
+    """
+    `since`の日以降の集計を種類・報酬タイプ・通貨ごとに合計して返します。
+    日別の集計だけを読むので、台帳の件数によらず期間の日数分の行しか読みません。
+    """
+    return await db.fetchall(
+        """
+        SELECT kind, reward_type, unit, SUM(count) AS count, SUM(amount) AS amount
+        FROM payout_rollups WHERE guild_id = ? AND day >= ?
+        GROUP BY kind, reward_type, unit ORDER BY kind, reward_type, unit
+        """,
+        (guild_id, since // SECONDS_PER_DAY)
+    )
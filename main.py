@@ -1,38 +1,117 @@
+from time import perf_counter
+_started_at = perf_counter()
+
+import sys
 import discord
 from discord import app_commands
 import bot_commands as cmds
 import config
+import metrics
+from sharding import ShardLayout
+
+metrics.startup_seconds.set(perf_counter() - _started_at, "imports")
 
 intents = discord.Intents.default()
-intents.members = True
-intents.presences = True
-intents.message_content = True 
+intents.members = config.Discord.intents_members
+intents.presences = config.Discord.intents_presences
+intents.message_content = config.Discord.intents_message_content
+
+def member_cache_flags(policy: str) -> discord.MemberCacheFlags:
+    if policy == "all":
+        return discord.MemberCacheFlags.all()
+    if policy == "voice":
+        return discord.MemberCacheFlags(voice=True, joined=False)
+    if policy == "none":
+        return discord.MemberCacheFlags.none()
+    raise ValueError(f"unknown member cache policy: {policy}")
+
+# 起動引数でこのプロセスの番号を指定する (例: python main.py 1)
+shard_layout = ShardLayout.from_config(
+    int(sys.argv[1]) if len(sys.argv) > 1 else 0,
+    config.Sharding.shard_count,
+    config.Sharding.processes
+)
+cmds.use_shard_layout(shard_layout)
+
+class SomeVCClient(discord.AutoShardedClient):
+    async def setup_hook(self):
+        if config.Metrics.enabled:
+            await metrics.start_http_server(config.Metrics.host, config.Metrics.port + shard_layout.process_index)
+        start = perf_counter()
+        await cmds.init_database()
+        metrics.startup_seconds.set(perf_counter() - start, "database")
+        start = perf_counter()
+        await cmds.start_vc_client()
+        metrics.startup_seconds.set(perf_counter() - start, "vc_client")
+        await cmds.start_reward_settler()
+        await cmds.start_payout_jobs()
+        await cmds.start_cooldown_compactor()
+
+        if not shard_layout.is_primary:
+            return
+        try:
+            if await cmds.sync_command_tree(tree):
+                print("スラッシュコマンドを同期しました。")
+            else:
+                print("スラッシュコマンドに変更はありません。")
+        except Exception as e:
+            print(f"コマンド同期エラー: {e}")
+
+    async def close(self):
+        # イベントの処理を先に止め、処理中の報酬が終わってから各種サービスを止める
+        await cmds.begin_shutdown()
+        await cmds.stop_voice_sessions()
+        await cmds.stop_reward_settler()
+        await cmds.stop_payout_jobs()
+        await cmds.stop_cooldown_compactor()
+        await cmds.close_vc_client()
+        await cmds.close_database()
+        await metrics.stop_http_server()
+        await super().close()
 
-client = discord.Client(intents=intents)
+client = SomeVCClient(
+    intents=intents,
+    member_cache_flags=member_cache_flags(config.Discord.member_cache),
+    # 全メンバーをキャッシュしない場合、メンバー一覧は必要なときにAPIから取得する
+    chunk_guilds_at_startup=config.Discord.member_cache == "all",
+    shard_count=shard_layout.shard_count,
+    shard_ids=list(shard_layout.shard_ids)
+)
+metrics.REGISTRY.collect(lambda: metrics.cached_members.set(cmds.cached_member_count(client.guilds), config.Discord.member_cache))
 tree = app_commands.CommandTree(client)
 
+tree.add_command(cmds.rain)
+tree.add_command(cmds.send_with_msg)
+tree.add_command(cmds.receive_msg)
+tree.add_command(cmds.admin_refresh)
+tree.add_command(cmds.admin_stats)
+
+tree.add_command(cmds.reward_pool)
+
+@tree.command(name="info",description="このボットに関する情報を表示します")
+async def info_command(interaction:discord.Interaction):
+    await interaction.response.defer(thinking=True)
+    await interaction.followup.send(embed=cmds.bot_info())
+
 @client.event
 async def on_ready():
-    print(f'" {client.user} "としてログイン中')
+    print(f'" {client.user} "としてログイン中 (シャード: {", ".join(map(str, shard_layout.shard_ids))}/{shard_layout.shard_count})')
+    if metrics.startup_seconds.get("ready") is None:
+        metrics.startup_seconds.set(perf_counter() - _started_at, "ready")
+        phases = ", ".join(f"{phase}: {metrics.startup_seconds.get(phase):.2f}s" for phase in ("imports", "database", "vc_client", "ready"))
+        print(f"起動時間 ({phases})")
+        print(f"メモリ使用量: {cmds.memory_usage_text(client.guilds)}")
     await client.change_presence(activity=discord.Game(name="Some VC Utils by h4ribote"),status=discord.Status.online)
+    await cmds.start_voice_sessions(client.guilds)
 
-    tree.add_command(cmds.rain)
-    tree.add_command(cmds.send_with_msg)
-    tree.add_command(cmds.receive_msg)
-    tree.add_command(cmds.admin_refresh)
-
-    tree.add_command(cmds.reward_pool)
-
-    @tree.command(name="info",description="このボットに関する情報を表示します")
-    async def info_command(interaction:discord.Interaction):
-        await interaction.response.defer(thinking=True)
-        await interaction.followup.send(embed=cmds.bot_info())
+@client.event
+async def on_shard_ready(shard_id: int):
+    # 再接続で切断中のボイスイベントを受け取れないため、セッションを突き合わせる
+    await cmds.sync_voice_sessions(client.guilds, shard_id)
 
-    try:
-        await tree.sync()
-        print("スラッシュコマンドを同期しました。")
-    except Exception as e:
-        print(f"コマンド同期エラー: {e}")
+@client.event
+async def on_voice_state_update(member:discord.Member, before:discord.VoiceState, after:discord.VoiceState):
+    await cmds.handle_voice_state(member, before, after)
 
 @client.event
 async def on_message(message:discord.Message):
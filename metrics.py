@@ -0,0 +1,197 @@
+import os
+import sys
+from bisect import bisect_left
+from typing import Callable, Optional
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names: tuple[str, ...], values: tuple, le: Optional[str] = None) -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if le is not None:
+        parts.append(f'le="{le}"')
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: dict[tuple, float] = {}
+
+    def set(self, value: float, *labels):
+        self._values[labels] = value
+
+    def get(self, *labels) -> Optional[float]:
+        return self._values.get(labels)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._counts: dict[tuple, list[int]] = {}
+        self._sums: dict[tuple, float] = {}
+
+    def observe(self, value: float, *labels):
+        counts = self._counts.get(labels)
+        if counts is None:
+            counts = self._counts[labels] = [0] * (len(self.buckets) + 1)
+            self._sums[labels] = 0.0
+        counts[bisect_left(self.buckets, value)] += 1
+        self._sums[labels] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, str(bound))} {cumulative}")
+            cumulative += counts[-1]
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, '+Inf')} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {self._sums[labels]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: list = []
+        self._collectors: list[Callable[[], None]] = []
+
+    def collect(self, fn: Callable[[], None]):
+        """
+        `render`の直前に呼び出す関数を登録します。値を都度計算するGaugeの更新に使います。
+        """
+        self._collectors.append(fn)
+
+    def counter(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> Counter:
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> Gauge:
+        metric = Gauge(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> Histogram:
+        metric = Histogram(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        for fn in self._collectors:
+            fn()
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+api_requests = REGISTRY.counter("vc_api_requests_total", "VirtualCrypto API requests", ("method", "endpoint", "status"))
+api_latency = REGISTRY.histogram("vc_api_request_seconds", "VirtualCrypto API request latency", ("method", "endpoint"))
+db_queries = REGISTRY.counter("db_queries_total", "SQLite queries", ("kind",))
+db_latency = REGISTRY.histogram("db_query_seconds", "Time a coroutine waited for a SQLite query", ("kind",))
+reward_outcomes = REGISTRY.counter("reward_outcomes_total", "handle_reward results", ("reward_type", "outcome"))
+cooldown_rows_compacted = REGISTRY.counter("cooldown_rows_compacted_total", "Expired user_reward_cooldowns rows removed by compaction")
+transfer_keys_pruned = REGISTRY.counter("transfer_keys_pruned_total", "Settled transfer_idempotency rows removed by compaction")
+startup_seconds = REGISTRY.gauge("startup_seconds", "Seconds spent in each startup phase", ("phase",))
+resident_memory = REGISTRY.gauge("process_resident_memory_bytes", "Resident memory size in bytes")
+cached_members = REGISTRY.gauge("discord_cached_members", "Members held in the discord.py member cache", ("policy",))
+
+
+def resident_memory_bytes() -> Optional[int]:
+    """
+    このプロセスの常駐メモリ量を返します。/procがない環境ではピーク値を返します。
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrssはLinuxではKiB、macOSではバイト単位
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _collect_process():
+    rss = resident_memory_bytes()
+    if rss is not None:
+        resident_memory.set(rss)
+
+REGISTRY.collect(_collect_process)
+
+
+def observe_api(method: str, endpoint: str, status: int, seconds: float):
+    api_requests.inc(method, endpoint, status)
+    api_latency.observe(seconds, method, endpoint)
+
+
+def observe_db(kind: str, seconds: float):
+    db_queries.inc(kind)
+    db_latency.observe(seconds, kind)
+
+
+_runner = None
+
+async def start_http_server(host: str, port: int):
+    """
+    Prometheusのテキスト形式で`/metrics`を公開するHTTPサーバーを起動します。
+    """
+    global _runner
+    if _runner is not None:
+        return
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(text=REGISTRY.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    _runner = web.AppRunner(app)
+    await _runner.setup()
+    await web.TCPSite(_runner, host, port).start()
+
+async def stop_http_server():
+    global _runner
+    if _runner is not None:
+        runner, _runner = _runner, None
+        await runner.cleanup()
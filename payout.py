@@ -0,0 +1,100 @@
+import asyncio
+from dataclasses import dataclass, field
+from typing import AsyncIterable, Awaitable, Callable, Iterable, Optional, Union
+
+import aiohttp
+
+from virtualcrypto import AsyncVirtualCryptoClient, MissingScope, TransferUncertain
+from virtualcrypto.errors import HTTPException
+
+
+@dataclass
+class PayoutResult:
+    receiver_id: int
+    amount: int
+    error: Optional[Exception] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+@dataclass
+class PayoutSummary:
+    results: list[PayoutResult] = field(default_factory=list)
+
+    @property
+    def paid(self) -> list[PayoutResult]:
+        return [r for r in self.results if r.ok]
+
+    @property
+    def failed(self) -> list[PayoutResult]:
+        return [r for r in self.results if not r.ok]
+
+    @property
+    def paid_amount(self) -> int:
+        return sum(r.amount for r in self.results if r.ok)
+
+
+def transfer_not_sent(error: BaseException) -> bool:
+    """
+    送金されていないことが確実なエラーの場合はTrueを返します。
+    `TransferUncertain`や想定外のエラーでは送金された可能性があるため、予約した残高を戻してはいけません。
+    """
+    if isinstance(error, TransferUncertain):
+        return False
+    # `pay`は送金のリクエストが届いた可能性のあるエラーをすべて`TransferUncertain`にする。
+    # トークンを取得できなかった場合は`TokenRefreshFailed`(HTTPException)になり、
+    # そのまま届く通信エラーは接続に失敗した場合の`ClientConnectorError`だけ
+    return isinstance(error, (HTTPException, MissingScope, aiohttp.ClientConnectorError))
+
+
+async def pay_all(
+    vc_client: AsyncVirtualCryptoClient,
+    unit: str,
+    payouts: Union[Iterable[tuple[int, int]], AsyncIterable[tuple[int, int]]],
+    concurrency: int = 8,
+    on_result: Optional[Callable[[PayoutResult], Awaitable[None]]] = None,
+    idempotency_key: Optional[Callable[[int], str]] = None
+) -> PayoutSummary:
+    """
+    (受取人id, 数量) の組を最大 `concurrency` 件ずつ並行して送金します。
+    各ワーカーは送金が終わるたびに次の組を取り出すため、遅い送金があっても他のワーカーは止まりません。
+    `payouts`には非同期イテラブルも渡せます。失敗しても残りの送金は継続し、全員分の結果をまとめて返します。
+    `idempotency_key`を指定した場合は受取人idから作ったキーで送金の重複を防ぎます。
+    """
+    summary = PayoutSummary()
+    if isinstance(payouts, AsyncIterable):
+        aiterator = payouts.__aiter__()
+        lock = asyncio.Lock()
+
+        async def next_payout() -> Optional[tuple[int, int]]:
+            # 非同期ジェネレーターは同時に進められないので1つずつ取り出す
+            async with lock:
+                try:
+                    return await aiterator.__anext__()
+                except StopAsyncIteration:
+                    return None
+    else:
+        iterator = iter(payouts)
+
+        async def next_payout() -> Optional[tuple[int, int]]:
+            return next(iterator, None)
+
+    async def worker():
+        while (payout := await next_payout()) is not None:
+            receiver_id, amount = payout
+            result = PayoutResult(receiver_id, amount)
+            try:
+                if idempotency_key:
+                    await vc_client.pay(unit, receiver_id, amount, idempotency_key=idempotency_key(receiver_id))
+                else:
+                    await vc_client.pay(unit, receiver_id, amount)
+            except Exception as e:
+                result.error = e
+            summary.results.append(result)
+            if on_result:
+                await on_result(result)
+
+    await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    return summary
@@ -0,0 +1,289 @@
+import asyncio
+import sqlite3
+from time import time
+from typing import AsyncIterable, Optional
+
+from virtualcrypto import AsyncVirtualCryptoClient
+from virtualcrypto.idempotency import SENT, FAILED
+from database import Database
+import ledger
+from payout import pay_all, PayoutResult, PayoutSummary
+
+
+class PayoutJobs:
+    """
+    一括送金を`payout_jobs`に、受取人ごとの送金を`payout_outbox`に保存し、バックグラウンドで送金します。
+    ジョブは請求の承認前に`staged`として作成しておき、承認された時点で`activate`により送金を始めます。
+    送金前に行を`sending`にしてから送金し、結果を`paid`か`failed`として記録します。
+    送金には行ごとの冪等キーを付け、再起動時は送金中に中断された行を`transfer_idempotency`の記録と照合します。
+    送金済みの行は`paid`に、送られていない行は`pending`に戻し、結果が分からない行は二重送金を避けるため`interrupted`にします。
+    請求の承認後に開始できなかったジョブは、再起動時に削除されないよう`held`として残します。
+    ジョブは作成したプロセスの`owner`で区別し、他のプロセスのジョブには触れません。
+    """
+    def __init__(self, db: Database, concurrency: int = 8, owner: int = 0, batch_size: int = 500):
+        self.db = db
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.owner = owner
+        self._tasks: dict[int, asyncio.Task] = {}
+        self._done: dict[int, asyncio.Future] = {}
+        self._stopping = False
+
+    @staticmethod
+    def create_table(cursor: sqlite3.Cursor):
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS payout_jobs (
+                job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                claim_id INTEGER,
+                owner INTEGER NOT NULL DEFAULT 0,
+                guild_id INTEGER,
+                unit TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'staged',
+                created_at INTEGER NOT NULL
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS payout_outbox (
+                job_id INTEGER NOT NULL,
+                receiver_id INTEGER NOT NULL,
+                amount INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                error TEXT,
+                PRIMARY KEY (job_id, receiver_id),
+                FOREIGN KEY (job_id) REFERENCES payout_jobs(job_id) ON DELETE CASCADE
+            )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_payout_outbox_status ON payout_outbox (job_id, status)")
+
+    @staticmethod
+    def _insert_job(cursor: sqlite3.Cursor, owner: int, guild_id: Optional[int], unit: str, created_at: int) -> int:
+        cursor.execute(
+            "INSERT INTO payout_jobs (owner, guild_id, unit, created_at) VALUES (?, ?, ?, ?)",
+            (owner, guild_id, unit, created_at)
+        )
+        return cursor.lastrowid
+
+    @staticmethod
+    def _insert_outbox(cursor: sqlite3.Cursor, job_id: int, payouts: list[tuple[int, int]]) -> int:
+        cursor.executemany(
+            "INSERT OR IGNORE INTO payout_outbox (job_id, receiver_id, amount) VALUES (?, ?, ?)",
+            ((job_id, receiver_id, amount) for receiver_id, amount in payouts)
+        )
+        return cursor.rowcount
+
+    @staticmethod
+    def _activate_job(cursor: sqlite3.Cursor, job_id: int, claim_id: int):
+        cursor.execute(
+            "UPDATE payout_jobs SET status = 'running', claim_id = ? WHERE job_id = ? AND status = 'staged'",
+            (claim_id, job_id)
+        )
+        if cursor.rowcount != 1:
+            raise ValueError(f"payout job {job_id} is not staged")
+
+    @staticmethod
+    def _hold_job(cursor: sqlite3.Cursor, job_id: int, claim_id: int):
+        cursor.execute(
+            "UPDATE payout_jobs SET status = 'held', claim_id = ? WHERE job_id = ? AND status = 'staged'",
+            (claim_id, job_id)
+        )
+
+    @staticmethod
+    def _delete_job(cursor: sqlite3.Cursor, job_id: int):
+        cursor.execute("DELETE FROM payout_outbox WHERE job_id = ?", (job_id,))
+        cursor.execute("DELETE FROM payout_jobs WHERE job_id = ?", (job_id,))
+
+    @staticmethod
+    def _take_batch(cursor: sqlite3.Cursor, job_id: int, limit: int) -> list[tuple[int, int]]:
+        cursor.execute(
+            "SELECT receiver_id, amount FROM payout_outbox WHERE job_id = ? AND status = 'pending' LIMIT ?",
+            (job_id, limit)
+        )
+        rows = [(row['receiver_id'], row['amount']) for row in cursor.fetchall()]
+        cursor.executemany(
+            "UPDATE payout_outbox SET status = 'sending' WHERE job_id = ? AND receiver_id = ?",
+            ((job_id, receiver_id) for receiver_id, _ in rows)
+        )
+        return rows
+
+    @staticmethod
+    def _return_batch(cursor: sqlite3.Cursor, job_id: int, rows: list[tuple[int, int]]):
+        cursor.executemany(
+            "UPDATE payout_outbox SET status = 'pending' WHERE job_id = ? AND receiver_id = ? AND status = 'sending'",
+            ((job_id, receiver_id) for receiver_id, _ in rows)
+        )
+
+    @staticmethod
+    def _finish_job(cursor: sqlite3.Cursor, job_id: int):
+        cursor.execute("UPDATE payout_jobs SET status = 'done' WHERE job_id = ?", (job_id,))
+
+    @staticmethod
+    def _record_result(cursor: sqlite3.Cursor, job: dict, result: PayoutResult, now: int):
+        if result.ok and job['guild_id'] is not None:
+            ledger.record(cursor, job['guild_id'], result.receiver_id, ledger.RAIN, job['unit'], result.amount, now)
+        cursor.execute(
+            "UPDATE payout_outbox SET status = ?, error = ? WHERE job_id = ? AND receiver_id = ?",
+            (
+                "paid" if result.ok else "failed",
+                None if result.ok else f"{type(result.error).__name__}: {result.error}",
+                job['job_id'], result.receiver_id
+            )
+        )
+
+    @staticmethod
+    def transfer_key(job_id: int, receiver_id: int) -> str:
+        return f"rain:{job_id}:{receiver_id}"
+
+    @staticmethod
+    def _recover(cursor: sqlite3.Cursor, owner: int, now: int) -> tuple[list[int], int]:
+        cursor.execute(
+            """
+            SELECT o.job_id, o.receiver_id, o.amount, j.guild_id, j.unit, t.state
+            FROM payout_outbox o
+            JOIN payout_jobs j ON j.job_id = o.job_id
+            LEFT JOIN transfer_idempotency t ON t.key = 'rain:' || o.job_id || ':' || o.receiver_id
+            WHERE o.status = 'sending' AND j.owner = ?
+            """,
+            (owner,)
+        )
+        interrupted = 0
+        for row in cursor.fetchall():
+            if row['state'] == SENT:
+                if row['guild_id'] is not None:
+                    ledger.record(cursor, row['guild_id'], row['receiver_id'], ledger.RAIN, row['unit'], row['amount'], now)
+                status, error = "paid", None
+            elif row['state'] is None or row['state'] == FAILED:
+                status, error = "pending", None
+            else:
+                status, error = "interrupted", "Interrupted while sending"
+                interrupted += 1
+            cursor.execute(
+                "UPDATE payout_outbox SET status = ?, error = ? WHERE job_id = ? AND receiver_id = ?",
+                (status, error, row['job_id'], row['receiver_id'])
+            )
+        # 承認されないまま終了したジョブは送金しない
+        cursor.execute(
+            "DELETE FROM payout_outbox WHERE job_id IN (SELECT job_id FROM payout_jobs WHERE status = 'staged' AND owner = ?)",
+            (owner,)
+        )
+        cursor.execute("DELETE FROM payout_jobs WHERE status = 'staged' AND owner = ?", (owner,))
+        cursor.execute("SELECT job_id FROM payout_jobs WHERE status = 'running' AND owner = ? ORDER BY job_id", (owner,))
+        return [row['job_id'] for row in cursor.fetchall()], interrupted
+
+    async def stage(self, guild_id: Optional[int], unit: str, payouts: AsyncIterable[tuple[int, int]], batch_size: int = 1000) -> tuple[int, int]:
+        """
+        (受取人id, 数量) の組を受け取った順に`batch_size`件ずつ保存し、(ジョブid, 受取人数) を返します。
+        同じ受取人は1回だけ数えます。途中で失敗した場合は保存した分を削除します。
+        """
+        job_id = await self.db.write(self._insert_job, self.owner, guild_id, unit, int(time()))
+        count = 0
+        batch = []
+        try:
+            async for payout in payouts:
+                batch.append(payout)
+                if len(batch) >= batch_size:
+                    count += await self.db.write(self._insert_outbox, job_id, batch)
+                    batch = []
+            if batch:
+                count += await self.db.write(self._insert_outbox, job_id, batch)
+        except BaseException:
+            await asyncio.shield(self.discard(job_id))
+            raise
+        return job_id, count
+
+    async def activate(self, vc_client: AsyncVirtualCryptoClient, job_id: int, claim_id: int):
+        """
+        請求が承認された`staged`のジョブの送金を開始します。
+        """
+        await self.db.write(self._activate_job, job_id, claim_id)
+        self._done[job_id] = asyncio.get_running_loop().create_future()
+        self._start(vc_client, job_id)
+
+    async def hold(self, job_id: int, claim_id: int):
+        """
+        請求は承認されたが開始できなかった`staged`のジョブを、手動で照合できるよう`held`として残します。
+        """
+        await self.db.write(self._hold_job, job_id, claim_id)
+
+    async def discard(self, job_id: int):
+        """
+        送金を始めていないジョブを削除します。
+        """
+        await self.db.write(self._delete_job, job_id)
+
+    async def wait(self, job_id: int) -> PayoutSummary:
+        """
+        `activate`で開始したジョブが終わるまで待ち、その送金結果を返します。
+        """
+        try:
+            return await asyncio.shield(self._done[job_id])
+        finally:
+            self._done.pop(job_id, None)
+
+    def _start(self, vc_client: AsyncVirtualCryptoClient, job_id: int):
+        self._tasks[job_id] = asyncio.create_task(self._run(vc_client, job_id))
+
+    async def _run(self, vc_client: AsyncVirtualCryptoClient, job_id: int):
+        summary = PayoutSummary()
+        done = self._done.get(job_id)
+
+        async def record(result: PayoutResult):
+            summary.results.append(result)
+            await self.db.write(self._record_result, job, result, int(time()))
+
+        async def pending():
+            # `batch_size`行ずつ取り出し、ワーカーには1行ずつ渡す
+            while not self._stopping and (batch := await self.db.write(self._take_batch, job_id, self.batch_size)):
+                for index, payout in enumerate(batch):
+                    if self._stopping:
+                        # まだ送金していない行は次回の起動で再開できるよう戻しておく
+                        await self.db.write(self._return_batch, job_id, batch[index:])
+                        return
+                    yield payout
+
+        try:
+            job = await self.db.fetchone("SELECT * FROM payout_jobs WHERE job_id = ?", (job_id,))
+            await pay_all(
+                vc_client, job['unit'], pending(),
+                concurrency=self.concurrency, on_result=record,
+                idempotency_key=lambda receiver_id: self.transfer_key(job_id, receiver_id)
+            )
+            if not self._stopping:
+                await self.db.write(self._finish_job, job_id)
+        except Exception as e:
+            print(f"Error in payout job {job_id}: {e}")
+            if done is not None:
+                done.set_exception(e)
+                done.exception()
+        else:
+            if done is None:
+                print(f"送金ジョブ{job_id}を完了しました ({len(summary.paid)}件成功, {len(summary.failed)}件失敗)")
+            elif self._stopping:
+                done.cancel()
+            else:
+                done.set_result(summary)
+        finally:
+            self._tasks.pop(job_id, None)
+
+    async def resume(self, vc_client: AsyncVirtualCryptoClient) -> list[int]:
+        """
+        前回の起動で終わらなかったジョブを再開し、再開したジョブidを返します。
+        """
+        job_ids, interrupted = await self.db.write(self._recover, self.owner, int(time()))
+        if interrupted:
+            print(f"送金中に中断され結果が分からない{interrupted}件の送金は再送せず`interrupted`として記録しました。")
+        for job_id in job_ids:
+            if job_id in self._tasks:
+                continue
+            self._start(vc_client, job_id)
+        return job_ids
+
+    def running(self) -> int:
+        return len(self._tasks)
+
+    async def stop(self):
+        """
+        新しい送金の開始を止め、送金中のものが終わるまで待ちます。
+        残りの送金は次回の起動時に`resume`で再開されます。
+        """
+        self._stopping = True
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
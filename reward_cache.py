@@ -0,0 +1,149 @@
+import heapq
+from typing import Optional
+
+from db_structs import RewardPool, RewardConfig
+from database import Database
+
+
+class RewardCache:
+    """
+    サーバーごとの報酬ルール(RewardConfig)と報酬プール(RewardPool)のメモリ上のキャッシュです。
+    起動時に全件を読み込み、以降は`/reward_pool`系コマンドから更新されます。
+    """
+    def __init__(self):
+        self._configs: dict[int, dict[str, RewardConfig]] = {}
+        self._pools: dict[int, RewardPool] = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def load(self, db: Database):
+        pools = await db.fetchall("SELECT * FROM reward_pools")
+        configs = await db.fetchall("SELECT * FROM reward_configs")
+        self._configs.clear()
+        self._pools.clear()
+        for row in pools:
+            pool = RewardPool.from_dict(row)
+            self._pools[pool.guild_id] = pool
+        for row in configs:
+            config = RewardConfig.from_dict(row)
+            self._configs.setdefault(config.guild_id, {})[config.reward_type] = config
+
+    async def reload_guild(self, db: Database, guild_id: int):
+        """
+        指定したサーバーの設定をデータベースから読み直します。
+        """
+        pool = RewardPool.from_dict(await db.fetchone("SELECT * FROM reward_pools WHERE guild_id = ?", (guild_id,)))
+        configs = {
+            c.reward_type: c
+            for c in map(RewardConfig.from_dict, await db.fetchall("SELECT * FROM reward_configs WHERE guild_id = ?", (guild_id,)))
+        }
+        if pool:
+            self._pools[guild_id] = pool
+        else:
+            self._pools.pop(guild_id, None)
+        if configs:
+            self._configs[guild_id] = configs
+        else:
+            self._configs.pop(guild_id, None)
+
+    def get_config(self, guild_id: int, reward_type: str) -> Optional[RewardConfig]:
+        configs = self._configs.get(guild_id)
+        config = configs.get(reward_type) if configs else None
+        if config:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return config
+
+    def get_pool(self, guild_id: int) -> Optional[RewardPool]:
+        return self._pools.get(guild_id)
+
+    def adjust_balance(self, guild_id: int, delta: int):
+        pool = self._pools.get(guild_id)
+        if pool:
+            pool.pool_balance += delta
+
+    def set_balance(self, guild_id: int, balance: int):
+        pool = self._pools.get(guild_id)
+        if pool:
+            pool.pool_balance = balance
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "guilds": len(self._pools),
+            "configs": sum(len(c) for c in self._configs.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "miss_rate": self.misses / total if total else 0.0
+        }
+
+
+class CooldownIndex:
+    """
+    (サーバーid, ユーザーid, 報酬タイプ) ごとの最終報酬時刻を保持するメモリ上のインデックスです。
+    クールダウンが明けたエントリは期限順のヒープから順に取り除かれます。
+    """
+    __slots__ = ("_last", "_expiry")
+
+    def __init__(self):
+        self._last: dict[tuple[int, int, str], int] = {}
+        self._expiry: list[tuple[int, tuple[int, int, str], int]] = []
+
+    def __len__(self) -> int:
+        return len(self._last)
+
+    _QUERY = """
+        SELECT c.user_id, c.guild_id, c.reward_type, c.last_triggered_timestamp, r.cooldown_seconds
+        FROM user_reward_cooldowns c
+        JOIN reward_configs r ON r.guild_id = c.guild_id AND r.reward_type = c.reward_type
+        WHERE c.last_triggered_timestamp + r.cooldown_seconds > ?
+    """
+
+    def _add_rows(self, rows: list[dict]):
+        for row in rows:
+            self.touch(row['guild_id'], row['user_id'], row['reward_type'],
+                       row['last_triggered_timestamp'], row['cooldown_seconds'])
+
+    async def load(self, db: Database, now: int):
+        """
+        `user_reward_cooldowns`からクールダウン中のエントリを全て読み込みます。
+        """
+        rows = await db.fetchall(self._QUERY, (now,))
+        self._last.clear()
+        self._expiry.clear()
+        self._add_rows(rows)
+
+    async def reload_guild(self, db: Database, now: int, guild_id: int):
+        """
+        指定したサーバーのエントリだけをデータベースから読み直します。
+        """
+        rows = await db.fetchall(self._QUERY + " AND c.guild_id = ?", (now, guild_id))
+        for key in [k for k in self._last if k[0] == guild_id]:
+            del self._last[key]
+        self._expiry = [e for e in self._expiry if e[1][0] != guild_id]
+        heapq.heapify(self._expiry)
+        self._add_rows(rows)
+
+    def _evict(self, now: int):
+        expiry = self._expiry
+        while expiry and expiry[0][0] <= now:
+            _, key, last = heapq.heappop(expiry)
+            if self._last.get(key) == last:
+                del self._last[key]
+
+    def on_cooldown(self, guild_id: int, user_id: int, reward_type: str, now: int, cooldown_seconds: int) -> bool:
+        self._evict(now)
+        last = self._last.get((guild_id, user_id, reward_type))
+        return last is not None and (now - last) < cooldown_seconds
+
+    def touch(self, guild_id: int, user_id: int, reward_type: str, now: int, cooldown_seconds: int):
+        if cooldown_seconds <= 0:
+            return
+        key = (guild_id, user_id, reward_type)
+        self._last[key] = now
+        heapq.heappush(self._expiry, (now + cooldown_seconds, key, now))
+
+    def clear(self, guild_id: int, user_id: int, reward_type: str):
+        self._last.pop((guild_id, user_id, reward_type), None)
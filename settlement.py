@@ -0,0 +1,220 @@
+import asyncio
+import sqlite3
+import uuid
+from collections import defaultdict
+from typing import Callable, Optional
+
+from virtualcrypto import AsyncVirtualCryptoClient
+from virtualcrypto.idempotency import SENT, FAILED
+from database import Database
+from payout import pay_all, transfer_not_sent, PayoutResult
+
+
+class RewardSettler:
+    """
+    少額の報酬を`pending_rewards`に積み立て、一定間隔または閾値到達時に
+    ユーザー・通貨ごとにまとめて送金します。プールからは積み立て時に差し引かれます。
+    精算する分は送金前に冪等キーと一緒に`reward_settlements`へ移し、送金できなかった分だけ積み立てに戻します。
+    送金されたか分からない分は二重送金を避けるため`unknown`として残し、手動での照合に任せます。
+    `owns`を指定した場合は、それがTrueを返すサーバーの積み立て分だけを精算します。
+    """
+    def __init__(self, db: Database, interval: int, threshold: int, concurrency: int = 8,
+                 owns: Optional[Callable[[int], bool]] = None):
+        self.db = db
+        self.interval = interval
+        self.threshold = threshold
+        self.concurrency = concurrency
+        self.owns = owns
+        self._wake = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    @staticmethod
+    def create_table(cursor: sqlite3.Cursor):
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS pending_rewards (
+                guild_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                unit TEXT NOT NULL,
+                amount INTEGER NOT NULL,
+                PRIMARY KEY (guild_id, user_id, unit)
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS reward_settlements (
+                settle_key TEXT NOT NULL,
+                guild_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                unit TEXT NOT NULL,
+                amount INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'sending',
+                PRIMARY KEY (settle_key, guild_id)
+            )
+        """)
+
+    def accrue(self, cursor: sqlite3.Cursor, guild_id: int, user_id: int, unit: str, amount: int) -> bool:
+        """
+        呼び出し元のトランザクション内で報酬を積み立てます。
+        積み立て額が閾値に達した場合はTrueを返すので、`wake`で次の精算を前倒ししてください。
+        """
+        cursor.execute(
+            """
+            INSERT INTO pending_rewards (guild_id, user_id, unit, amount) VALUES (?, ?, ?, ?)
+            ON CONFLICT(guild_id, user_id, unit) DO UPDATE SET amount = amount + excluded.amount
+            """,
+            (guild_id, user_id, unit, amount)
+        )
+        cursor.execute(
+            "SELECT amount FROM pending_rewards WHERE guild_id = ? AND user_id = ? AND unit = ?",
+            (guild_id, user_id, unit)
+        )
+        row = cursor.fetchone()
+        return bool(row) and row['amount'] >= self.threshold
+
+    def wake(self):
+        self._wake.set()
+
+    @staticmethod
+    def _claim(cursor: sqlite3.Cursor, owns: Optional[Callable[[int], bool]]) -> list[tuple[str, str, int, int]]:
+        """
+        積み立て分をユーザー・通貨ごとに冪等キーを付けて`reward_settlements`へ移し、
+        (冪等キー, 通貨単位, ユーザーid, 数量) のリストを返します。
+        """
+        cursor.execute("SELECT * FROM pending_rewards WHERE amount > 0")
+        groups: dict[tuple[str, int], list[dict]] = defaultdict(list)
+        for row in cursor.fetchall():
+            if owns and not owns(row['guild_id']):
+                continue
+            groups[(row['unit'], row['user_id'])].append(row)
+
+        batch = []
+        for (unit, user_id), rows in groups.items():
+            key = f"settle:{uuid.uuid4().hex}"
+            for row in rows:
+                cursor.execute(
+                    "INSERT INTO reward_settlements (settle_key, guild_id, user_id, unit, amount) VALUES (?, ?, ?, ?, ?)",
+                    (key, row['guild_id'], user_id, unit, row['amount'])
+                )
+                cursor.execute(
+                    "DELETE FROM pending_rewards WHERE guild_id = ? AND user_id = ? AND unit = ?",
+                    (row['guild_id'], user_id, unit)
+                )
+            batch.append((key, unit, user_id, sum(row['amount'] for row in rows)))
+        return batch
+
+    @staticmethod
+    def _restore(cursor: sqlite3.Cursor, key: str):
+        """
+        送金されなかった分を積み立てに戻します。
+        """
+        cursor.execute(
+            """
+            INSERT INTO pending_rewards (guild_id, user_id, unit, amount)
+            SELECT guild_id, user_id, unit, amount FROM reward_settlements WHERE settle_key = ?
+            ON CONFLICT(guild_id, user_id, unit) DO UPDATE SET amount = amount + excluded.amount
+            """,
+            (key,)
+        )
+        cursor.execute("DELETE FROM reward_settlements WHERE settle_key = ?", (key,))
+
+    @classmethod
+    def _record_result(cls, cursor: sqlite3.Cursor, key: str, result: PayoutResult):
+        if result.ok:
+            cursor.execute("DELETE FROM reward_settlements WHERE settle_key = ?", (key,))
+        elif transfer_not_sent(result.error):
+            cls._restore(cursor, key)
+        else:
+            cursor.execute("UPDATE reward_settlements SET status = 'unknown' WHERE settle_key = ?", (key,))
+
+    @classmethod
+    def _recover(cls, cursor: sqlite3.Cursor, owns: Optional[Callable[[int], bool]]) -> int:
+        cursor.execute(
+            """
+            SELECT s.settle_key, s.guild_id, t.state
+            FROM reward_settlements s
+            LEFT JOIN transfer_idempotency t ON t.key = s.settle_key
+            WHERE s.status = 'sending'
+            """
+        )
+        states = {row['settle_key']: row['state'] for row in cursor.fetchall() if not owns or owns(row['guild_id'])}
+        unknown = 0
+        for key, state in states.items():
+            if state == SENT:
+                cursor.execute("DELETE FROM reward_settlements WHERE settle_key = ?", (key,))
+            elif state is None or state == FAILED:
+                cls._restore(cursor, key)
+            else:
+                cursor.execute("UPDATE reward_settlements SET status = 'unknown' WHERE settle_key = ?", (key,))
+                unknown += 1
+        return unknown
+
+    async def resume(self):
+        """
+        前回の起動で送金中に中断された精算を冪等キーの記録と照合します。
+        送金済みの分は精算済みに、送られていない分は積み立てに戻し、結果が分からない分は`unknown`として残します。
+        """
+        unknown = await self.db.write(self._recover, self.owns)
+        if unknown:
+            print(f"送金中に中断され結果が分からない{unknown}件の精算は再送せず`unknown`として記録しました。")
+
+    async def settle(self, vc_client: AsyncVirtualCryptoClient) -> int:
+        """
+        積み立て済みの報酬をユーザー・通貨ごとに1回の送金で精算し、送金した件数を返します。
+        """
+        async with self._lock:
+            batch = await self.db.write(self._claim, self.owns)
+
+            by_unit: dict[str, list[tuple[int, int]]] = defaultdict(list)
+            keys: dict[tuple[str, int], str] = {}
+            for key, unit, user_id, amount in batch:
+                by_unit[unit].append((user_id, amount))
+                keys[(unit, user_id)] = key
+
+            settled = 0
+            for unit, payouts in by_unit.items():
+                async def record(result: PayoutResult, unit=unit):
+                    await self.db.write(self._record_result, keys[(unit, result.receiver_id)], result)
+
+                summary = await pay_all(
+                    vc_client, unit, payouts,
+                    concurrency=self.concurrency, on_result=record,
+                    idempotency_key=lambda user_id, unit=unit: keys[(unit, user_id)]
+                )
+                for result in summary.failed:
+                    if transfer_not_sent(result.error):
+                        print(f"Error in settle for {result.receiver_id} ({result.amount} {unit}): {result.error}")
+                    else:
+                        print(f"Settlement {keys[(unit, result.receiver_id)]} for {result.receiver_id} ({result.amount} {unit}) may have been sent, left for manual reconciliation: {result.error}")
+                settled += len(summary.paid)
+            return settled
+
+    async def _run(self, vc_client: AsyncVirtualCryptoClient):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            if self._stopping:
+                return
+            try:
+                await self.settle(vc_client)
+            except Exception as e:
+                print(f"Error in reward settlement: {e}")
+
+    def start(self, vc_client: AsyncVirtualCryptoClient):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(vc_client))
+
+    async def stop(self, vc_client: AsyncVirtualCryptoClient):
+        """
+        実行中の精算が終わるのを待ってから精算タスクを止め、残っている積み立て分を精算します。
+        精算の途中で中断すると送金中の分が`unknown`として残るため、キャンセルはしません。
+        """
+        self._stopping = True
+        self._wake.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self.settle(vc_client)
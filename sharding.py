@@ -0,0 +1,33 @@
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class ShardLayout:
+    """
+    このプロセスが担当するシャードの情報です。
+    サーバーはDiscordと同じ`(guild_id >> 22) % shard_count`でシャードに割り当てられるため、
+    1つのサーバーのイベントとコマンドは常に同じプロセスに届きます。
+    """
+    process_index: int
+    process_count: int
+    shard_count: int
+    shard_ids: tuple[int, ...]
+
+    @classmethod
+    def from_config(cls, process_index: int, shard_count: int, processes: list[list[int]]) -> "ShardLayout":
+        assigned = sorted(shard_id for shard_ids in processes for shard_id in shard_ids)
+        if assigned != list(range(shard_count)):
+            raise ValueError(f"processes must assign each of the {shard_count} shards to exactly one process")
+        if not 0 <= process_index < len(processes):
+            raise ValueError(f"process index must be between 0 and {len(processes) - 1}")
+        return cls(process_index, len(processes), shard_count, tuple(processes[process_index]))
+
+    @property
+    def is_primary(self) -> bool:
+        return self.process_index == 0
+
+    def shard_for(self, guild_id: int) -> int:
+        return (guild_id >> 22) % self.shard_count
+
+    def owns(self, guild_id: int) -> bool:
+        return self.shard_for(guild_id) in self.shard_ids
@@ -1,9 +1,28 @@
 """Top-level package for VirtualCrypto.py."""
-from .structs import User, Currency, Claim, ClaimStatus, Scope, Balance
-from .errors import VirtualCryptoException, MissingScope, BadRequest
-from .client import VirtualCryptoClient
-from .async_client import AsyncVirtualCryptoClient
+from .structs import User, Currency, Claim, ClaimStatus, Scope, Balance, TransferResult
+from .errors import VirtualCryptoException, MissingScope, BadRequest, RateLimited, TokenRefreshFailed, TransferUncertain
+from .idempotency import IdempotencyStore, MemoryIdempotencyStore
 
 __author__ = """sizumita"""
 __email__ = 'contact@sumidora.com'
 __version__ = '0.1.3'
+
+# The clients pull in requests / aiohttp, so they are only imported when first used.
+_LAZY = {
+    "VirtualCryptoClient": ".client",
+    "AsyncVirtualCryptoClient": ".async_client",
+}
+
+
+def __getattr__(name):
+    module = _LAZY.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    from importlib import import_module
+    value = getattr(import_module(module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_LAZY))
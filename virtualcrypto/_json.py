@@ -0,0 +1,11 @@
+"""JSON decoding that uses orjson when it is installed."""
+try:
+    import orjson
+
+    def loads(data):
+        return orjson.loads(data)
+except ImportError:
+    import json
+
+    def loads(data):
+        return json.loads(data)
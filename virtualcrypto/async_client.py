@@ -1,98 +1,251 @@
 from .structs import Currency, Scope, Claim, ClaimStatus, Balance
-from .errors import MissingScope, BadRequest, NotFound
-from .client import VirtualCryptoClientBase, VIRTUALCRYPTO_TOKEN_ENDPOINT, VIRTUALCRYPTO_API
-from typing import Optional, List
+from .errors import MissingScope, HTTPException, BadRequest, NotFound, RateLimited, TokenRefreshFailed, TransferUncertain
+from .ratelimit import RateLimiter, parse_retry_after
+from .idempotency import IdempotencyStore, MemoryIdempotencyStore, SENT, FAILED, UNKNOWN
+from .token import TokenManager
+from ._json import loads
+from .base import VirtualCryptoClientBase, VIRTUALCRYPTO_ENDPOINT
+from typing import Optional, List, Callable
 import aiohttp
 import asyncio
-from time import time
+import random
+import re
+import uuid
+from time import time, perf_counter
 
 
 class AsyncVirtualCryptoClient(VirtualCryptoClientBase):
-    def __init__(self, client_id: str, client_secret: str, scopes: List[Scope]):
-        super().__init__(client_id, client_secret, scopes)
+    def __init__(self, client_id: str, client_secret: str, scopes: List[Scope],
+                 connection_limit: int = 100, dns_cache_ttl: int = 300, keepalive_timeout: float = 30.0,
+                 rate_limit: Optional[float] = None, rate_burst: int = 1, max_rate_limit_retries: int = 3,
+                 request_timeout: float = 10.0, max_retries: int = 2, retry_backoff: float = 0.5,
+                 hedge_delay: Optional[float] = None, idempotency_store: Optional[IdempotencyStore] = None,
+                 token_refresh_margin: float = 60, token_cache_path: Optional[str] = None,
+                 endpoint: str = VIRTUALCRYPTO_ENDPOINT):
+        super().__init__(client_id, client_secret, scopes, endpoint)
         self.loop = asyncio.get_running_loop()
-        self.session = aiohttp.ClientSession(loop=self.loop)
-        self.wait_ready = asyncio.Event(loop=self.loop)
+        connector = aiohttp.TCPConnector(
+            limit=connection_limit,
+            limit_per_host=connection_limit,
+            ttl_dns_cache=dns_cache_ttl,
+            keepalive_timeout=keepalive_timeout
+        )
+        self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=request_timeout))
+        self.wait_ready = asyncio.Event()
+        self.rate_limiter = RateLimiter(rate_limit, rate_burst)
+        self.max_rate_limit_retries = max_rate_limit_retries
+        # retries with jittered backoff; GETs are also hedged after hedge_delay seconds
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.hedge_delay = hedge_delay
+        self.idempotency_store = idempotency_store or MemoryIdempotencyStore()
+        # transfers without a key only need protecting against their own retries
+        self._retry_keys = MemoryIdempotencyStore()
+        self.tokens = TokenManager(
+            self._fetch_token,
+            cache_key=f"{self.token_endpoint} {self.client_id} {self._scope()}",
+            refresh_margin=token_refresh_margin,
+            cache_path=token_cache_path
+        )
+        # called with (method, endpoint, status, seconds) after every API request
+        self.on_request: Optional[Callable[[str, str, int, float], None]] = None
 
     async def wait_for_ready(self):
         await self.wait_ready.wait()
 
     async def start(self):
-        await self.set_token()
+        await self.tokens.start()
         self.wait_ready.set()
 
     async def close(self):
+        await self.tokens.close()
         await self.session.close()
 
-    async def set_token(self):
+    def _scope(self) -> str:
+        return ' '.join(map(lambda x: x.value, self.scopes))
+
+    async def _fetch_token(self) -> dict:
         body = {
-            'scope': ' '.join(map(lambda x: x.value, self.scopes)),
+            'scope': self._scope(),
             'grant_type': 'client_credentials'
         }
-        async with self.session.post(
-                VIRTUALCRYPTO_TOKEN_ENDPOINT,
-                data=body,
-                auth=aiohttp.BasicAuth(self.client_id, self.client_secret)) as response:
-            data = await response.json()
+        try:
+            async with self.session.post(
+                    self.token_endpoint,
+                    data=body,
+                    auth=aiohttp.BasicAuth(self.client_id, self.client_secret)) as response:
+                response.raise_for_status()
+                data = await response.json()
+            data['access_token'], data['token_type'], data['expires_in']
+        except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError) as e:
+            raise TokenRefreshFailed(f"could not get an access token: {e!r}") from e
 
-        self.token = data['access_token']
         self.expires_in = data['expires_in']
-        self.token_type = data['token_type']
         self.when_set_token = int(time())
+        return data
+
+    async def set_token(self):
+        await self.tokens.refresh()
+
+    @property
+    def token(self) -> Optional[str]:
+        return self.tokens.token
+
+    @token.setter
+    def token(self, value: Optional[str]):
+        # VirtualCryptoClientBase.__init__ assigns None before the manager exists
+        if value is not None:
+            self.tokens.token = value
 
     async def get_headers(self):
-        if (int(time()) - self.when_set_token) >= self.expires_in:
-            await self.set_token()
         return {
-            "Authorization": "Bearer " + self.token
+            "Authorization": "Bearer " + await self.tokens.get()
         }
 
-    async def get(self, path, params) -> aiohttp.ClientResponse:
-        headers = await self.get_headers()
+    async def request(self, method: str, path: str, **kwargs) -> aiohttp.ClientResponse:
+        refreshed = False
+        for _ in range(self.max_rate_limit_retries + 1):
+            await self.rate_limiter.acquire()
+            headers = await self.get_headers()
+            start = perf_counter()
+            response = await self.session.request(method, self.api + path, headers=headers, **kwargs)
+            # read the body so the connection goes back to the pool right away
+            await response.read()
+            if self.on_request:
+                self.on_request(method, re.sub(r"/\d+", "/{id}", path), response.status, perf_counter() - start)
+            if response.status == 401 and not refreshed:
+                # a cached token may have been revoked; a rejected request was not processed
+                refreshed = True
+                await self.tokens.refresh(stale=headers["Authorization"][len("Bearer "):])
+                continue
+            if response.status != 429:
+                return response
+            self.rate_limiter.block(parse_retry_after(response.headers.get("Retry-After")))
+        raise RateLimited(f"{method} {path} was rate limited")
 
-        return await self.session.get(VIRTUALCRYPTO_API + path, params=params, headers=headers)
+    async def _backoff(self, attempt: int):
+        await asyncio.sleep(random.uniform(0, self.retry_backoff * 2 ** attempt))
+
+    async def _hedged(self, method: str, path: str, **kwargs) -> aiohttp.ClientResponse:
+        if self.hedge_delay is None:
+            return await self.request(method, path, **kwargs)
+        first = asyncio.ensure_future(self.request(method, path, **kwargs))
+        done, _ = await asyncio.wait({first}, timeout=self.hedge_delay)
+        if done:
+            return first.result()
+        # the first request is slow: send a second one and take whichever answers first
+        pending = {first, asyncio.ensure_future(self.request(method, path, **kwargs))}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def request_idempotent(self, method: str, path: str, **kwargs) -> aiohttp.ClientResponse:
+        """Send a request that is safe to repeat, retrying timeouts, connection errors and 5xx responses."""
+        for attempt in range(self.max_retries + 1):
+            last = attempt == self.max_retries
+            try:
+                response = await self._hedged(method, path, **kwargs)
+            except (aiohttp.ClientError, asyncio.TimeoutError, TokenRefreshFailed):
+                if last:
+                    raise
+            else:
+                if response.status < 500 or last:
+                    return response
+            await self._backoff(attempt)
+
+    async def get(self, path, params) -> aiohttp.ClientResponse:
+        return await self.request_idempotent("GET", path, params=params)
 
     async def post(self, path, data) -> aiohttp.ClientResponse:
-        headers = await self.get_headers()
-        return await self.session.post(VIRTUALCRYPTO_API + path, data=data, headers=headers)
+        return await self.request("POST", path, data=data)
 
     async def patch(self, path, data) -> aiohttp.ClientResponse:
-        headers = await self.get_headers()
-        return await self.session.patch(VIRTUALCRYPTO_API + path, data=data, headers=headers)
+        return await self.request("PATCH", path, data=data)
 
     async def get_currency_by_unit(self, unit: str) -> Optional[Currency]:
         response = await self.get("/currencies", {"unit": unit})
 
-        return Currency.by_json(await response.json())
+        return Currency.by_json(loads(await response.read()))
 
     async def get_currency_by_guild(self, guild_id: int) -> Optional[Currency]:
         response = await self.get("/currencies", {"guild": str(guild_id)})
 
-        return Currency.by_json(await response.json())
+        return Currency.by_json(loads(await response.read()))
 
     async def get_currency_by_name(self, name: str) -> Optional[Currency]:
         response = await self.get("/currencies", {"name": name})
-        return Currency.by_json(await response.json())
+        return Currency.by_json(loads(await response.read()))
 
     async def get_currency(self, currency_id: int):
         response = await self.get("/currencies/" + str(currency_id), {})
 
-        return Currency.by_json(await response.json())
+        return Currency.by_json(loads(await response.read()))
 
-    async def create_user_transaction(self, unit: str, receiver_discord_id: int, amount: int) -> None:
+    async def create_user_transaction(self, unit: str, receiver_discord_id: int, amount: int,
+                                      idempotency_key: Optional[str] = None) -> None:
+        """
+        Send a transfer. It is only retried when the request certainly did not
+        reach the API (connection failures and 429s); if the outcome is unknown
+        :class:`TransferUncertain` is raised instead. Passing the same
+        ``idempotency_key`` again never sends a transfer that was already sent.
+        """
         if Scope.Pay not in self.scopes:
             raise MissingScope("vc.pay")
 
-        response = await self.post(
-            "/users/@me/transactions",
-            {
-                "unit": unit,
-                "receiver_discord_id": str(receiver_discord_id),
-                "amount": str(amount)
-            }
-        )
-        if response.status == 400:
-            raise BadRequest((await response.json())["error_info"])
+        if idempotency_key:
+            key, store = idempotency_key, self.idempotency_store
+        else:
+            key, store = uuid.uuid4().hex, self._retry_keys
+        for attempt in range(self.max_retries + 1):
+            state = await store.begin(key)
+            if state == SENT:
+                return
+            if state is not None:
+                raise TransferUncertain(f"transfer {key} is {state}")
+
+            try:
+                response = await self.post(
+                    "/users/@me/transactions",
+                    {
+                        "unit": unit,
+                        "receiver_discord_id": str(receiver_discord_id),
+                        "amount": str(amount)
+                    }
+                )
+            except TokenRefreshFailed:
+                # the token is fetched before the transaction request, so nothing was sent
+                await store.finish(key, FAILED)
+                raise
+            except (aiohttp.ClientConnectorError, RateLimited):
+                # never reached the API, so the transfer was not made
+                await store.finish(key, FAILED)
+                if attempt == self.max_retries:
+                    raise
+                await self._backoff(attempt)
+                continue
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                await store.finish(key, UNKNOWN)
+                raise TransferUncertain(f"transfer {key} may have been sent: {e!r}") from e
+
+            if response.status >= 500:
+                await store.finish(key, UNKNOWN)
+                raise TransferUncertain(f"transfer {key} may have been sent: HTTP {response.status}")
+            if response.status >= 400:
+                await store.finish(key, FAILED)
+                if response.status == 400:
+                    raise BadRequest(loads(await response.read())["error_info"])
+                raise HTTPException(f"HTTP {response.status}")
+            await store.finish(key, SENT)
+            return
 
     pay = create_user_transaction
 
@@ -102,8 +255,8 @@ class AsyncVirtualCryptoClient(VirtualCryptoClientBase):
             {"payer_discord_id":str(payer_discord_id),"unit":unit,"amount":str(amount)}
         )
         if response.status == 400:
-            raise BadRequest((await response.json())["error_description"])
-        return Claim.by_json(await response.json())
+            raise BadRequest(loads(await response.read())["error_description"])
+        return Claim.by_json(loads(await response.read()))
 
     async def get_claims(self):
         if Scope.Claim not in self.scopes:
@@ -113,11 +266,11 @@ class AsyncVirtualCryptoClient(VirtualCryptoClientBase):
             "/users/@me/claims",
             {}
         )
-        return list(map(Claim.by_json, await response.json()))
+        return Claim.by_json_list(loads(await response.read()))
 
     async def get_claim(self, claim_id: int):
         response = await self.get("/users/@me/claims/" + str(claim_id), {})
-        return Claim.by_json(await response.json())
+        return Claim.by_json(loads(await response.read()))
 
     async def update_claim(self, claim_id: int, status: ClaimStatus):
         if status == ClaimStatus.Pending:
@@ -129,9 +282,9 @@ class AsyncVirtualCryptoClient(VirtualCryptoClientBase):
         )
 
         if response.status == 404:
-            raise NotFound((await response.json())["error_description"])
+            raise NotFound(loads(await response.read())["error_description"])
         elif response.status == 400:
-            raise BadRequest((await response.json())["error_info"])
+            raise BadRequest(loads(await response.read())["error_info"])
 
         return response
 
@@ -140,4 +293,4 @@ class AsyncVirtualCryptoClient(VirtualCryptoClientBase):
             "/users/@me/balances",
             {}
         )
-        return list(map(Balance.by_json, await response.json()))
+        return Balance.by_json_list(loads(await response.read()))
@@ -0,0 +1,142 @@
+from .structs import Scope, ClaimStatus
+from typing import List
+VIRTUALCRYPTO_ENDPOINT = "https://vcrypto.sumidora.com"
+VIRTUALCRYPTO_API = VIRTUALCRYPTO_ENDPOINT + "/api/v1"
+VIRTUALCRYPTO_TOKEN_ENDPOINT = VIRTUALCRYPTO_ENDPOINT + "/oauth2/token"
+
+
+class VirtualCryptoClientBase:
+    def __init__(self, client_id: str, client_secret: str, scopes: List[Scope], endpoint: str = VIRTUALCRYPTO_ENDPOINT):
+        self.endpoint = endpoint
+        self.api = endpoint + "/api/v1"
+        self.token_endpoint = endpoint + "/oauth2/token"
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.scopes = scopes
+        self.token = None
+        self.expires_in = None
+        self.token_type = None
+        self.when_set_token = None
+
+    def set_token(self):
+        pass
+
+    def get_headers(self):
+        pass
+
+    def get(self, path: str, params: dict):
+        pass
+
+    def post(self, path, data):
+        pass
+
+    def patch(self, path, data):
+        pass
+
+    def get_currency_by_unit(self, unit: str):
+        """
+
+        Get Currency information by it's unit
+
+        Parameters
+        ----------
+        unit: :class:`str`
+            The currency's unit
+        """
+        pass
+
+    def get_currency_by_guild(self, guild_id: int):
+        """
+
+        Get Currency information by it's guild
+
+        Parameters
+        ----------
+        guild_id: :class:`int`
+            The currency's guild id
+        """
+        pass
+
+    def get_currency_by_name(self, name: str):
+        """
+
+        Get Currency information by it's name
+
+        Parameters
+        ----------
+        name: :class:`str`
+            The currency's unit
+        """
+        pass
+
+    def get_currency(self, currency_id: int):
+        r"""
+
+        Get Currency information by it's id
+
+        Parameters
+        ----------
+        currency_id: :class:`int`
+            The currency's id
+        """
+        pass
+
+    def create_user_transaction(self, unit: str, receiver_discord_id: int, amount: int):
+        """
+
+        Pay currency for another user.
+
+        Parameters
+        ----------
+        unit: :class:`str`
+            The currency's unit
+        receiver_discord_id: :class:`int`
+            Who gets currencies
+        amount: :class:`int`
+            The currency's amount
+        """
+        pass
+
+    def get_claims(self):
+        """
+
+        Get **pending** claims
+        You can get both you send and received claims.
+
+        """
+        pass
+
+    def get_claim(self, claim_id: int):
+        """
+
+        Get claim by id
+
+        Parameters
+        ----------
+        claim_id: :class:`int`
+            The getting claim id
+
+        """
+        pass
+
+    def update_claim(self, claim_id: int, status: ClaimStatus):
+        """
+
+        Update Claim status
+
+        Parameters
+        ----------
+        claim_id: :class:`int`
+            The chaim id
+        status: :class:`.ClaimStatus`
+            The status you want to change. You can use Approved, Canceled and Denied.
+        """
+        pass
+
+    def get_balances(self):
+        """
+
+        Get all balances
+
+        """
+        pass
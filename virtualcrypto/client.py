@@ -1,160 +1,44 @@
 from requests.auth import HTTPBasicAuth
+from requests.adapters import HTTPAdapter
 import requests
-from .structs import Currency, Scope, Claim, ClaimStatus, Balance
-from .errors import MissingScope, BadRequest, NotFound
-from typing import Optional, List, Iterable
+from .structs import Currency, Scope, Claim, ClaimStatus, Balance, TransferResult
+from .errors import MissingScope, HTTPException, BadRequest, NotFound, TransferUncertain
+from ._json import loads
+from .base import VirtualCryptoClientBase, VIRTUALCRYPTO_ENDPOINT, VIRTUALCRYPTO_API, VIRTUALCRYPTO_TOKEN_ENDPOINT
+from typing import Optional, List, Iterable, Tuple
+from concurrent.futures import ThreadPoolExecutor
 import datetime
-VIRTUALCRYPTO_ENDPOINT = "https://vcrypto.sumidora.com"
-VIRTUALCRYPTO_API = VIRTUALCRYPTO_ENDPOINT + "/api/v1"
-VIRTUALCRYPTO_TOKEN_ENDPOINT = VIRTUALCRYPTO_ENDPOINT + "/oauth2/token"
+import threading
 
 
-class VirtualCryptoClientBase:
-    def __init__(self, client_id: str, client_secret: str, scopes: List[Scope]):
-        self.client_id = client_id
-        self.client_secret = client_secret
-        self.scopes = scopes
-        self.token = None
-        self.expires_in = None
-        self.token_type = None
-        self.when_set_token = None
-
-    def set_token(self):
-        pass
-
-    def get_headers(self):
-        pass
-
-    def get(self, path: str, params: dict):
-        pass
-
-    def post(self, path, data):
-        pass
-
-    def patch(self, path, data):
-        pass
-
-    def get_currency_by_unit(self, unit: str):
-        """
-
-        Get Currency information by it's unit
-
-        Parameters
-        ----------
-        unit: :class:`str`
-            The currency's unit
-        """
-        pass
-
-    def get_currency_by_guild(self, guild_id: int):
-        """
-
-        Get Currency information by it's guild
-
-        Parameters
-        ----------
-        guild_id: :class:`int`
-            The currency's guild id
-        """
-        pass
-
-    def get_currency_by_name(self, name: str):
-        """
-
-        Get Currency information by it's name
-
-        Parameters
-        ----------
-        name: :class:`str`
-            The currency's unit
-        """
-        pass
-
-    def get_currency(self, currency_id: int):
-        r"""
-
-        Get Currency information by it's id
-
-        Parameters
-        ----------
-        currency_id: :class:`int`
-            The currency's id
-        """
-        pass
-
-    def create_user_transaction(self, unit: str, receiver_discord_id: int, amount: int):
-        """
-
-        Pay currency for another user.
-
-        Parameters
-        ----------
-        unit: :class:`str`
-            The currency's unit
-        receiver_discord_id: :class:`int`
-            Who gets currencies
-        amount: :class:`int`
-            The currency's amount
-        """
-        pass
-
-    def get_claims(self):
-        """
-
-        Get **pending** claims
-        You can get both you send and received claims.
-
-        """
-        pass
-
-    def get_claim(self, claim_id: int):
-        """
-
-        Get claim by id
-
-        Parameters
-        ----------
-        claim_id: :class:`int`
-            The getting claim id
-
-        """
-        pass
-
-    def update_claim(self, claim_id: int, status: ClaimStatus):
-        """
-
-        Update Claim status
-
-        Parameters
-        ----------
-        claim_id: :class:`int`
-            The chaim id
-        status: :class:`.ClaimStatus`
-            The status you want to change. You can use Approved, Canceled and Denied.
-        """
-        pass
-
-    def get_balances(self):
-        """
-
-        Get all balances
+class VirtualCryptoClient(VirtualCryptoClientBase):
+    def __init__(self, client_id, client_secret, scopes, pool_size: int = 16, max_workers: int = 8,
+                 endpoint: str = VIRTUALCRYPTO_ENDPOINT):
+        super().__init__(client_id, client_secret, scopes, endpoint)
+        self.max_workers = max_workers
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(pool_size, max_workers))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._token_lock = threading.Lock()
+        self.set_token()
 
-        """
-        pass
+    def close(self):
+        self.session.close()
 
+    def __enter__(self):
+        return self
 
-class VirtualCryptoClient(VirtualCryptoClientBase):
-    def __init__(self, client_id, client_secret, scopes):
-        super().__init__(client_id, client_secret, scopes)
-        self.set_token()
+    def __exit__(self, *exc):
+        self.close()
 
     def set_token(self):
         body = {
             'scope': ' '.join(map(lambda x: x.value, self.scopes)),
             'grant_type': 'client_credentials'
         }
-        data = requests.post(
-            VIRTUALCRYPTO_TOKEN_ENDPOINT,
+        data = self.session.post(
+            self.token_endpoint,
             data=body,
             auth=HTTPBasicAuth(self.client_id, self.client_secret)
         ).json()
@@ -164,8 +48,10 @@ class VirtualCryptoClient(VirtualCryptoClientBase):
         self.when_set_token = datetime.datetime.utcnow()
 
     def get_headers(self):
-        if (datetime.datetime.utcnow() - self.when_set_token).seconds >= self.expires_in:
-            self.set_token()
+        if (datetime.datetime.utcnow() - self.when_set_token).total_seconds() >= self.expires_in:
+            with self._token_lock:
+                if (datetime.datetime.utcnow() - self.when_set_token).total_seconds() >= self.expires_in:
+                    self.set_token()
         return {
             "Authorization": "Bearer " + self.token,
             "Content-Type": "application/json"
@@ -173,8 +59,8 @@ class VirtualCryptoClient(VirtualCryptoClientBase):
 
     def get(self, path, params, version="v1") -> requests.Response:
         headers = self.get_headers()
-        response = requests.get(
-            f"{VIRTUALCRYPTO_ENDPOINT}/api/{version}{path}",
+        response = self.session.get(
+            f"{self.endpoint}/api/{version}{path}",
             params=params,
             headers=headers
         )
@@ -182,8 +68,8 @@ class VirtualCryptoClient(VirtualCryptoClientBase):
 
     def post(self, path, data, version="v1") -> requests.Response:
         headers = self.get_headers()
-        response = requests.post(
-            f"{VIRTUALCRYPTO_ENDPOINT}/api/{version}{path}",
+        response = self.session.post(
+            f"{self.endpoint}/api/{version}{path}",
             headers=headers,
             json=data
         )
@@ -191,24 +77,24 @@ class VirtualCryptoClient(VirtualCryptoClientBase):
 
     def patch(self, path, data) -> requests.Response:
         headers = self.get_headers()
-        response = requests.patch(
-            VIRTUALCRYPTO_API + path,
+        response = self.session.patch(
+            self.api + path,
             data=data,
             headers=headers
         )
         return response
 
     def get_currency_by_unit(self, unit: str) -> Optional[Currency]:
-        return Currency.by_json(self.get("/currencies", {"unit": unit}).json())
+        return Currency.by_json(loads(self.get("/currencies", {"unit": unit}).content))
 
     def get_currency_by_guild(self, guild_id: int) -> Optional[Currency]:
-        return Currency.by_json(self.get("/currencies", {"guild": str(guild_id)}).json())
+        return Currency.by_json(loads(self.get("/currencies", {"guild": str(guild_id)}).content))
 
     def get_currency_by_name(self, name: str) -> Optional[Currency]:
-        return Currency.by_json(self.get("/currencies", {"name": name}).json())
+        return Currency.by_json(loads(self.get("/currencies", {"name": name}).content))
 
     def get_currency(self, currency_id: int):
-        return Currency.by_json(self.get("/currencies/" + str(currency_id), {}, version="v2").json())
+        return Currency.by_json(loads(self.get("/currencies/" + str(currency_id), {}, version="v2").content))
 
     def create_user_transaction(self, unit: str, receiver_discord_id: int, amount: int) -> None:
         if Scope.Pay not in self.scopes:
@@ -222,23 +108,58 @@ class VirtualCryptoClient(VirtualCryptoClientBase):
                 "amount": str(amount)
             }
         )
+        if response.status_code >= 500:
+            raise TransferUncertain(f"transfer may have been sent: HTTP {response.status_code}")
         if response.status_code == 400:
-            raise BadRequest(response.json()["error_info"])
+            raise BadRequest(loads(response.content)["error_info"])
+        if response.status_code >= 400:
+            raise HTTPException(f"HTTP {response.status_code}")
 
     pay = create_user_transaction
 
+    def pay_many(self, unit: str, transfers: Iterable[Tuple[int, int]], max_workers: Optional[int] = None) -> List[TransferResult]:
+        """
+
+        Pay currency to many users in parallel on a bounded thread pool.
+        A failed transfer does not stop the others.
+
+        Parameters
+        ----------
+        unit: :class:`str`
+            The currency's unit
+        transfers: Iterable[Tuple[:class:`int`, :class:`int`]]
+            Pairs of (receiver_discord_id, amount)
+        max_workers: Optional[:class:`int`]
+            How many transfers may run at once. Defaults to the client's ``max_workers``.
+
+        Returns
+        -------
+        List[:class:`.TransferResult`]
+            One result per transfer, in the same order as ``transfers``.
+        """
+        def transfer(item: Tuple[int, int]) -> TransferResult:
+            receiver_discord_id, amount = item
+            result = TransferResult(receiver_discord_id, amount)
+            try:
+                self.create_user_transaction(unit, receiver_discord_id, amount)
+            except Exception as e:
+                result.error = e
+            return result
+
+        with ThreadPoolExecutor(max_workers=max_workers or self.max_workers) as executor:
+            return list(executor.map(transfer, transfers))
+
     def create_claim(self, payer_discord_id: int, unit: str, amount: int, metadata: dict={}, version="v2") -> Claim:
-        headers = self.get_headers()
-        response = requests.post(
-            f"{VIRTUALCRYPTO_ENDPOINT}/api/{version}/users/@me/claims",
-            headers=headers,
-            json={"payer_discord_id":str(payer_discord_id),"unit":unit,"amount":str(amount),"metadata":metadata}
+        response = self.post(
+            "/users/@me/claims",
+            {"payer_discord_id":str(payer_discord_id),"unit":unit,"amount":str(amount),"metadata":metadata},
+            version=version
         )
         try:
             response.raise_for_status()
         except requests.exceptions.HTTPError as e:
-            raise BadRequest(e.response.json())
-        return Claim.by_json(response.json())
+            raise BadRequest(loads(e.response.content))
+        return Claim.by_json(loads(response.content))
 
     def get_claims(self):
         if Scope.Claim not in self.scopes:
@@ -248,10 +169,10 @@ class VirtualCryptoClient(VirtualCryptoClientBase):
             "/users/@me/claims",
             {}
         )
-        return list(map(Claim.by_json, response.json()))
+        return Claim.by_json_list(loads(response.content))
 
     def get_claim(self, claim_id: int):
-        data = self.get("/users/@me/claims/" + str(claim_id), {}, "v2").json()
+        data = loads(self.get("/users/@me/claims/" + str(claim_id), {}, "v2").content)
         return Claim.by_json(data)
 
     def update_claim(self, claim_id: int, status: ClaimStatus):
@@ -264,9 +185,9 @@ class VirtualCryptoClient(VirtualCryptoClientBase):
         )
 
         if response.status_code == 404:
-            raise NotFound(response.json()["error_description"])
+            raise NotFound(loads(response.content)["error_description"])
         elif response.status_code == 400:
-            raise BadRequest(response.json()["error_info"])
+            raise BadRequest(loads(response.content)["error_info"])
 
         return response
 
@@ -275,4 +196,4 @@ class VirtualCryptoClient(VirtualCryptoClientBase):
             "/users/@me/balances",
             {}
         )
-        return list(map(Balance.by_json, response.json()))
+        return Balance.by_json_list(loads(response.content))
@@ -16,3 +16,17 @@ class BadRequest(HTTPException):
 
 class NotFound(HTTPException):
     pass
+
+
+class RateLimited(HTTPException):
+    pass
+
+
+class TokenRefreshFailed(HTTPException):
+    """An access token could not be obtained, so the request was not sent."""
+    pass
+
+
+class TransferUncertain(HTTPException):
+    """The transfer may or may not have been made, so it was not retried."""
+    pass
@@ -0,0 +1,56 @@
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Optional
+
+# Transfer states kept per idempotency key
+SENDING = "sending"
+SENT = "sent"
+FAILED = "failed"
+UNKNOWN = "unknown"
+
+
+class IdempotencyStore(ABC):
+    """
+    Records the state of every transfer by idempotency key so that a transfer
+    is never sent twice, even when a request is retried.
+
+    Subclass this to keep the records somewhere that survives a restart.
+    """
+    @abstractmethod
+    async def begin(self, key: str) -> Optional[str]:
+        """
+        Mark ``key`` as being sent and return ``None`` if it may be sent.
+        If the key is already ``sending``, ``sent`` or ``unknown`` nothing is
+        recorded and that state is returned instead. ``failed`` keys may be
+        sent again.
+        """
+
+    @abstractmethod
+    async def finish(self, key: str, state: str):
+        """Record the final state (``sent``, ``failed`` or ``unknown``) of ``key``."""
+
+
+class MemoryIdempotencyStore(IdempotencyStore):
+    """
+    Keeps the most recent ``max_size`` keys in memory.
+    Only protects retries within the running process.
+    """
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self._states: OrderedDict[str, str] = OrderedDict()
+
+    async def begin(self, key: str) -> Optional[str]:
+        state = self._states.get(key)
+        if state is not None and state != FAILED:
+            return state
+        self._set(key, SENDING)
+        return None
+
+    async def finish(self, key: str, state: str):
+        self._set(key, state)
+
+    def _set(self, key: str, state: str):
+        self._states[key] = state
+        self._states.move_to_end(key)
+        while len(self._states) > self.max_size:
+            self._states.popitem(last=False)
@@ -0,0 +1,84 @@
+import asyncio
+from email.utils import parsedate_to_datetime
+from time import monotonic, time
+from typing import Optional
+
+
+def parse_retry_after(value: Optional[str], default: float = 1.0) -> float:
+    """Parse a ``Retry-After`` header given either in seconds or as an HTTP date."""
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time())
+    except (TypeError, ValueError):
+        return default
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every request of a client.
+
+    Parameters
+    ----------
+    rate: Optional[:class:`float`]
+        Requests per second. ``None`` disables pacing but still honours ``Retry-After``.
+    burst: :class:`int`
+        How many requests may be sent back to back.
+    """
+    def __init__(self, rate: Optional[float] = None, burst: int = 1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+        self.acquired = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.throttled = 0
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self) -> float:
+        """Wait for a free slot and return how long the caller was queued."""
+        start = monotonic()
+        async with self._lock:
+            while True:
+                now = monotonic()
+                if now < self._blocked_until:
+                    await asyncio.sleep(self._blocked_until - now)
+                    continue
+                if self.rate is None:
+                    break
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    break
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+        waited = monotonic() - start
+        self.acquired += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        return waited
+
+    def block(self, seconds: float):
+        """Hold every caller back for ``seconds``, e.g. after a 429 response."""
+        self.throttled += 1
+        self._blocked_until = max(self._blocked_until, monotonic() + seconds)
+        self._tokens = 0.0
+
+    def stats(self) -> dict:
+        return {
+            "acquired": self.acquired,
+            "throttled": self.throttled,
+            "total_wait": self.total_wait,
+            "average_wait": self.total_wait / self.acquired if self.acquired else 0.0,
+            "max_wait": self.max_wait
+        }
@@ -1,7 +1,6 @@
 from dataclasses import dataclass
 from enum import Enum
-from requests import Response
-from typing import Optional
+from typing import Optional, List
 
 
 class ClaimStatus(Enum):
@@ -16,7 +15,32 @@ class Scope(Enum):
     Claim = "vc.claim"
 
 
-@dataclass
+_MISSING = object()
+
+
+class _Lazy:
+    """Decode a nested object from the raw payload the first time it is read."""
+    def __init__(self, key: str, decode):
+        self.key = key
+        self.decode = decode
+
+    def __set_name__(self, owner, name):
+        self.slot = "_" + name
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        value = getattr(obj, self.slot)
+        if value is _MISSING:
+            value = self.decode(obj._data[self.key])
+            setattr(obj, self.slot, value)
+        return value
+
+    def __set__(self, obj, value):
+        setattr(obj, self.slot, value)
+
+
+@dataclass(slots=True)
 class DiscordUser:
     id: int
     username: str
@@ -43,7 +67,7 @@ class DiscordUser:
         )
 
 
-@dataclass
+@dataclass(slots=True)
 class User:
     id: int
     discord: DiscordUser
@@ -53,7 +77,7 @@ class User:
         return cls(id=int(data["id"]), discord=DiscordUser.by_json(data["discord"]))
 
 
-@dataclass
+@dataclass(slots=True)
 class Currency:
     unit: str
     guild: int
@@ -75,29 +99,54 @@ class Currency:
         )
 
 
-@dataclass
 class Claim:
-    id: int
-    amount: int
-    claimant: User
-    payer: User
-    currency: Currency
-    status: ClaimStatus
-    created_at: str
-    updated_at: str
+    """
+    Claims are usually fetched in bulk and only ``id`` and ``status`` are read,
+    so ``claimant``, ``payer`` and ``currency`` are decoded on first access.
+    """
+    __slots__ = ("id", "amount", "status", "created_at", "updated_at", "_claimant", "_payer", "_currency", "_data")
+
+    claimant: User = _Lazy("claimant", User.by_json)
+    payer: User = _Lazy("payer", User.by_json)
+    currency: Currency = _Lazy("currency", Currency.by_json)
+
+    def __init__(self, id: int, amount: int, claimant: User, payer: User, currency: Currency,
+                 status: ClaimStatus, created_at: str, updated_at: str):
+        self.id = id
+        self.amount = amount
+        self.claimant = claimant
+        self.payer = payer
+        self.currency = currency
+        self.status = status
+        self.created_at = created_at
+        self.updated_at = updated_at
+        self._data = None
 
     @classmethod
     def by_json(cls, data):
-        return cls(
-            id=int(data["id"]),
-            amount=int(data["amount"]),
-            claimant=User.by_json(data["claimant"]),
-            payer=User.by_json(data["payer"]),
-            currency=Currency.by_json(data["currency"]),
-            status=ClaimStatus(data["status"]),
-            created_at=data["created_at"],
-            updated_at=data["updated_at"]
-        )
+        self = cls.__new__(cls)
+        self.id = int(data["id"])
+        self.amount = int(data["amount"])
+        self.status = ClaimStatus(data["status"])
+        self.created_at = data["created_at"]
+        self.updated_at = data["updated_at"]
+        self._claimant = self._payer = self._currency = _MISSING
+        self._data = data
+        return self
+
+    @classmethod
+    def by_json_list(cls, data: list) -> List["Claim"]:
+        by_json = cls.by_json
+        return [by_json(item) for item in data]
+
+    def __repr__(self):
+        return f"Claim(id={self.id!r}, amount={self.amount!r}, status={self.status!r}, created_at={self.created_at!r}, updated_at={self.updated_at!r})"
+
+    def __eq__(self, other):
+        if not isinstance(other, Claim):
+            return NotImplemented
+        return (self.id, self.amount, self.status, self.created_at, self.updated_at, self.claimant, self.payer, self.currency) == \
+            (other.id, other.amount, other.status, other.created_at, other.updated_at, other.claimant, other.payer, other.currency)
 
     def approve(self, client):
         return client.update_claim(self.id, ClaimStatus.Approved)
@@ -109,14 +158,44 @@ class Claim:
         return client.update_claim(self.id, ClaimStatus.Canceled)
 
 
-@dataclass
 class Balance:
-    amount: int
-    currency: Currency
+    __slots__ = ("amount", "_currency", "_data")
+
+    currency: Currency = _Lazy("currency", Currency.by_json)
+
+    def __init__(self, amount: int, currency: Currency):
+        self.amount = amount
+        self.currency = currency
+        self._data = None
 
     @classmethod
     def by_json(cls, data):
-        return cls(
-            amount=int(data['amount']),
-            currency=Currency.by_json(data['currency'])
-        )
+        self = cls.__new__(cls)
+        self.amount = int(data['amount'])
+        self._currency = _MISSING
+        self._data = data
+        return self
+
+    @classmethod
+    def by_json_list(cls, data: list) -> List["Balance"]:
+        by_json = cls.by_json
+        return [by_json(item) for item in data]
+
+    def __repr__(self):
+        return f"Balance(amount={self.amount!r}, currency={self.currency!r})"
+
+    def __eq__(self, other):
+        if not isinstance(other, Balance):
+            return NotImplemented
+        return (self.amount, self.currency) == (other.amount, other.currency)
+
+
+@dataclass(slots=True)
+class TransferResult:
+    receiver_discord_id: int
+    amount: int
+    error: Optional[Exception] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
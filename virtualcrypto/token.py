@@ -0,0 +1,152 @@
+import asyncio
+import json
+import os
+from time import time
+from typing import Awaitable, Callable, Optional
+
+
+class TokenManager:
+    """
+    Keeps an OAuth access token fresh for an async client.
+
+    The token is refreshed in the background ``refresh_margin`` seconds before
+    it expires, concurrent refreshes are merged into one token request, and the
+    token is optionally cached in ``cache_path`` so a restart can reuse it.
+
+    Parameters
+    ----------
+    fetch: Callable[[], Awaitable[:class:`dict`]]
+        Requests a new token and returns the token endpoint's JSON response.
+    cache_key: :class:`str`
+        Identifies the client and scopes; a cached token is only reused if it matches.
+    refresh_margin: :class:`float`
+        How many seconds before expiry the token is refreshed.
+    cache_path: Optional[:class:`str`]
+        File to cache the token in. ``None`` disables the cache.
+    """
+    def __init__(self, fetch: Callable[[], Awaitable[dict]], cache_key: str,
+                 refresh_margin: float = 60, cache_path: Optional[str] = None):
+        self.fetch = fetch
+        self.cache_key = cache_key
+        self.refresh_margin = refresh_margin
+        self.cache_path = cache_path
+        self.token: Optional[str] = None
+        self.token_type: Optional[str] = None
+        self.expires_at = 0.0
+        self.refreshes = 0
+        self._inflight: Optional[asyncio.Future] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def valid(self, now: Optional[float] = None) -> bool:
+        return self.token is not None and (time() if now is None else now) < self.expires_at
+
+    async def get(self) -> str:
+        """Return a valid token, waiting for a refresh only if the current one has expired."""
+        if not self.valid():
+            await self.refresh()
+        return self.token
+
+    async def refresh(self, stale: Optional[str] = None):
+        """
+        Request a new token. Callers that arrive while a refresh is running wait
+        for that refresh instead of starting another one. If ``stale`` is given
+        and the token has already changed, nothing is requested.
+        """
+        if stale is not None and self.token != stale and self.valid():
+            return
+        while (inflight := self._inflight) is not None:
+            try:
+                await asyncio.shield(inflight)
+                return
+            except asyncio.CancelledError:
+                # the task that was refreshing was cancelled, so take over the refresh
+                if not inflight.cancelled():
+                    raise
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight = future
+        try:
+            data = await self.fetch()
+            self._set(data['access_token'], data['token_type'], time() + data['expires_in'])
+            self.refreshes += 1
+            await self._save()
+        except Exception as e:
+            future.set_exception(e)
+            # avoid "exception was never retrieved" when nobody else was waiting
+            future.exception()
+            raise
+        else:
+            future.set_result(None)
+        finally:
+            # also covers cancellation, so waiters are never left hanging
+            if not future.done():
+                future.cancel()
+            self._inflight = None
+
+    def _set(self, token: str, token_type: str, expires_at: float):
+        self.token = token
+        self.token_type = token_type
+        self.expires_at = expires_at
+
+    def _read_cache(self) -> Optional[dict]:
+        try:
+            with open(self.cache_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_cache(self, data: dict):
+        # several processes may share the cache file, so each writes its own temporary file
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.cache_path)
+
+    async def _load(self) -> bool:
+        if not self.cache_path:
+            return False
+        data = await asyncio.get_running_loop().run_in_executor(None, self._read_cache)
+        if not data or data.get("key") != self.cache_key:
+            return False
+        self._set(data["access_token"], data["token_type"], data["expires_at"])
+        return self.valid(time() + self.refresh_margin)
+
+    async def _save(self):
+        if not self.cache_path:
+            return
+        data = {
+            "key": self.cache_key,
+            "access_token": self.token,
+            "token_type": self.token_type,
+            "expires_at": self.expires_at
+        }
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._write_cache, data)
+        except OSError as e:
+            print(f"Failed to cache VirtualCrypto token: {e}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(max(0.0, self.expires_at - self.refresh_margin - time()))
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(f"Error refreshing VirtualCrypto token: {e}")
+                await asyncio.sleep(min(30.0, max(1.0, self.refresh_margin / 4)))
+
+    async def start(self):
+        """Load a cached token or request a new one, then start refreshing in the background."""
+        if not await self._load():
+            await self.refresh()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,114 @@
+import asyncio
+from time import monotonic
+from typing import Awaitable, Callable, Iterable, Optional
+
+import discord
+
+SECONDS_PER_MINUTE = 60
+
+
+class VoiceSessions:
+    """
+    ボイスチャンネルに参加しているメンバーの参加時刻だけを記録し、経過した分数を報酬として精算します。
+    メンバーごとのタイマーやチャンネルの監視は行わず、退出時と`interval`秒ごとのチェックポイントでまとめて精算します。
+    1分に満たない端数は次の精算に持ち越し、退出時には切り捨てます。
+    """
+    def __init__(self, settle: Callable[[discord.Member, int], Awaitable[bool]], interval: float = 300):
+        self.settle = settle
+        self.interval = interval
+        self._sessions: dict[tuple[int, int], tuple[discord.Member, float]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __contains__(self, member: discord.Member) -> bool:
+        return (member.guild.id, member.id) in self._sessions
+
+    def join(self, member: discord.Member, now: Optional[float] = None):
+        key = (member.guild.id, member.id)
+        if key not in self._sessions:
+            self._sessions[key] = (member, monotonic() if now is None else now)
+
+    async def leave(self, member: discord.Member, now: Optional[float] = None):
+        session = self._sessions.pop((member.guild.id, member.id), None)
+        if session is not None:
+            minutes = int(((monotonic() if now is None else now) - session[1]) // SECONDS_PER_MINUTE)
+            await self._settle(member, minutes)
+
+    async def reconcile(self, members: Iterable[discord.Member], in_scope: Callable[[int], bool],
+                        now: Optional[float] = None) -> tuple[int, int]:
+        """
+        再接続の後など、退出や参加のイベントを受け取れなかった可能性があるときに、
+        現在ボイスチャンネルにいる`members`とセッションを突き合わせます。
+        `in_scope`がTrueを返すサーバーのセッションのうち`members`にいないものは精算して終了し、
+        セッションのないメンバーは新しく開始します。(開始した数, 終了した数) を返します。
+        """
+        now = monotonic() if now is None else now
+        present = {(member.guild.id, member.id): member for member in members}
+        gone = [member for key, (member, _) in self._sessions.items() if in_scope(key[0]) and key not in present]
+        joined = 0
+        for key, member in present.items():
+            if key not in self._sessions:
+                self.join(member, now)
+                joined += 1
+        await asyncio.gather(*(self.leave(member, now) for member in gone))
+        return joined, len(gone)
+
+    async def _settle(self, member: discord.Member, minutes: int) -> bool:
+        if minutes <= 0:
+            return True
+        try:
+            return await self.settle(member, minutes)
+        except Exception as e:
+            print(f"Error in voice reward for {member.id}: {e}")
+            return True
+
+    async def checkpoint(self, now: Optional[float] = None) -> int:
+        """
+        参加中の全員の経過分を精算し、精算したセッションの数を返します。
+        """
+        now = monotonic() if now is None else now
+        due = []
+        for key, (member, started) in list(self._sessions.items()):
+            minutes = int((now - started) // SECONDS_PER_MINUTE)
+            if minutes > 0:
+                # 精算中に退出しても同じ分数を二重に精算しないよう、先に起点を進めておく
+                advanced = (member, started + minutes * SECONDS_PER_MINUTE)
+                self._sessions[key] = advanced
+                due.append((key, member, started, minutes, advanced))
+
+        results = await asyncio.gather(*(self._settle(member, minutes) for _, member, _, minutes, _ in due))
+        for (key, member, started, _, advanced), ok in zip(due, results):
+            # `settle`がFalseを返した場合(クールダウン中など)は次回に持ち越す
+            if not ok and self._sessions.get(key) == advanced:
+                self._sessions[key] = (member, started)
+        return sum(results)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=self.interval)
+                return
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.checkpoint()
+            except Exception as e:
+                print(f"Error in voice checkpoint: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        実行中のチェックポイントが終わるのを待ってからチェックポイントを止め、参加中の全員の経過分を精算します。
+        精算の途中で中断すると、差し引いたプールの残高が送金も記録もされずに残るため、キャンセルはしません。
+        """
+        self._stopping.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self.checkpoint()